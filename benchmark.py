@@ -0,0 +1,280 @@
+"""
+Нагрузочный тест бота без обращения к VK.
+
+Запускает VKinderBot на синтетических событиях Long Poll против локальной
+имитации API VK (users.search, photos.getAll, execute, messages.send)
+с настраиваемой задержкой и базы данных SQLite или PostgreSQL.
+
+Пример запуска:
+    python benchmark.py --users 200 --rounds 20 --latency 50
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+
+from collections import defaultdict
+from types import SimpleNamespace
+
+from sqlalchemy import event
+from vk_api.exceptions import ApiError
+from vk_api.longpoll import VkEventType
+
+import vkinder
+from dispatcher import EventDispatcher
+from ratelimit import TokenBucket
+from token_pool import TokenPool
+
+# Количество найденных пользователей для одного набора критериев
+SEARCH_TOTAL = 1000
+# Количество фото у каждой анкеты
+PHOTOS_PER_USER = 20
+
+
+class FakeVkApi:
+    """
+    Имитация API VK с задержкой ответа и подсчетом вызовов
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        """
+        :param latency:    Задержка ответа в секундах
+        :param error_rate: Доля вызовов, завершающихся внутренней ошибкой сервера VK
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(0)
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def method(self, name, values=None):
+        """
+        Вызов метода API
+        :param name:   Название метода
+        :param values: Параметры
+        :return:       Ответ метода
+        """
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            with self.lock:
+                self.calls["errors"] += 1
+            raise ApiError(self, name, values, False, {"error_code": 10, "error_msg": "Internal server error"})
+        handler = getattr(self, name.replace(".", "_"))
+        return handler(**(values or {}))
+
+    def get_api(self):
+        return FakeMethod(self)
+
+    @staticmethod
+    def users_search(count=20, offset=0, age_from=0, sex=0, city=0, status=0, birth_month=0, **kwargs):
+        # Анкеты зависят только от критериев, поэтому кэш поиска работает как в реальности.
+        # Без фильтра по месяцу рождения найдено в 12 раз больше анкет, чем отдает поиск,
+        # и отдаются анкеты января
+        month = int(birth_month) or 1
+        base = ((((int(age_from) * 3 + int(sex)) * 100 + int(city)) * 6 + int(status)) * 13 + month) * SEARCH_TOTAL
+        count = max(0, min(int(count), SEARCH_TOTAL - int(offset)))
+        now = int(time.time())
+        items = [{"id": base + offset + i, "is_closed": (offset + i) % 7 == 0, "photo_id": "1_1",
+                  "has_photo": int((offset + i) % 5 != 0), "online": int((offset + i) % 3 == 0),
+                  "last_seen": {"time": now - (offset + i) * 3600}, "interests": "музыка, кино"[:(offset + i) % 13],
+                  "relation": int(status)}
+                 for i in range(count)]
+        return {"count": SEARCH_TOTAL if birth_month else SEARCH_TOTAL * 12, "items": items}
+
+    @staticmethod
+    def photos_getAll(owner_id, **kwargs):
+        items = [{"owner_id": owner_id, "id": i, "likes": {"count": (owner_id * i) % 97},
+                  "comments": {"count": i % 5}, "tags": {"count": i % 3}}
+                 for i in range(PHOTOS_PER_USER)]
+        return {"count": len(items), "items": items}
+
+    def execute(self, code, **kwargs):
+        # Скрипт постраничной загрузки фото: вложенные вызовы считаются отдельно,
+        # чтобы видеть реальную нагрузку на API
+        owners = [int(owner) for owner in re.search(r"var owners = \[([^\]]*)\]", code).group(1).split(",")]
+        with self.lock:
+            self.calls["execute.photos.getAll"] += len(owners)
+        result = []
+        for owner in owners:
+            items = self.photos_getAll(owner)["items"]
+            page = {field: [item[field] for item in items] for field in ("id", "likes", "comments", "tags")}
+            result.append({"owner_id": owner, "pages": [page]})
+        return result
+
+    @staticmethod
+    def messages_send(**kwargs):
+        return 1
+
+
+class FakeMethod:
+    """
+    Обращение к методам в стиле vk_api: api.users.search(...)
+    """
+
+    def __init__(self, vk, name=None):
+        self.vk = vk
+        self.name = name
+
+    def __getattr__(self, name):
+        return FakeMethod(self.vk, name if self.name is None else f"{self.name}.{name}")
+
+    def __call__(self, **kwargs):
+        return self.vk.method(self.name, kwargs)
+
+
+def make_scenario(users, rounds, seed=0):
+    """
+    Синтетические события: каждый пользователь проходит шаги
+    возраст -> пол -> город -> положение, затем листает анкеты
+
+    :param users:  Количество пользователей
+    :param rounds: Количество действий после поиска
+    :param seed:   Зерно генератора случайных чисел
+    :return:       Список событий
+    """
+    rnd = random.Random(seed)
+    flows = []
+    for user_id in range(1, users + 1):
+        texts = ["Начать поиск", str(rnd.choice((20, 25, 30))), rnd.choice("12"),
+                 rnd.choice(("1", "2", "99")), rnd.choice("15")]
+        texts += [rnd.choices(("еще", "в избранное", "избранное"), (8, 1, 1))[0] for _ in range(rounds)]
+        flows.append([user_id, texts])
+
+    # Сообщения разных пользователей перемешаны, порядок сообщений одного пользователя сохранен
+    events = []
+    while flows:
+        flow = rnd.choice(flows)
+        events.append(SimpleNamespace(type=VkEventType.MESSAGE_NEW, to_me=True, from_user=True,
+                                      user_id=flow[0], text=flow[1].pop(0)))
+        if not flow[1]:
+            flows.remove(flow)
+    return events
+
+
+def percentile(values, percent):
+    """
+    Перцентиль по методу ближайшего ранга
+    :param values:  Отсортированный список значений
+    :param percent: Перцентиль
+    :return:        Значение
+    """
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def make_bot(vk, connstr):
+    """
+    Создание бота, работающего с имитацией API
+    :param vk:      Объект FakeVkApi
+    :param connstr: Строка подключения к базе данных
+    :return:        Объект VKinderBot
+    """
+    bot = vkinder.VKinderBot(token="benchmark", connstr=connstr)
+    bot.api = vk.get_api()
+    bot.outbox.api = bot.api
+    bot.outbox.bucket = TokenBucket(rate=10 ** 6)
+    bot.vkinder.pool = TokenPool([vk], rate=10 ** 6)
+    vkinder.search_cache.clear()
+    vkinder.photo_cache.clear()
+    return bot
+
+
+def run(users, rounds, latency, concurrency, connstr, error_rate=0.0):
+    """
+    Запуск нагрузочного теста
+
+    :param users:       Количество пользователей
+    :param rounds:      Количество действий каждого пользователя после поиска
+    :param latency:     Задержка ответа API в секундах
+    :param concurrency: Количество одновременно обрабатываемых пользователей
+    :param connstr:     Строка подключения к базе данных
+    :param error_rate:  Доля вызовов API, завершающихся ошибкой
+    :return:            Словарь с результатами
+    """
+    vk = FakeVkApi(latency, error_rate)
+    bot = make_bot(vk, connstr)
+
+    db_queries = [0]
+
+    @event.listens_for(bot.user_data.engine, "before_cursor_execute")
+    def count_query(*args):
+        db_queries[0] += 1
+
+    # Время обработки события в зависимости от шага пользователя
+    timings = defaultdict(list)
+    process_message = bot.process_message
+
+    def timed_process_message(message):
+        # Сессия берется только из памяти, чтобы не добавлять лишних запросов к БД
+        session = bot.user_data_cache.peek(message.user_id)
+        step = str(session.step) if session is not None else "new"
+        start = time.perf_counter()
+        process_message(message)
+        timings[step].append(time.perf_counter() - start)
+
+    bot.process_message = timed_process_message
+
+    events = make_scenario(users, rounds)
+    dispatcher = EventDispatcher(bot, concurrency=concurrency)
+    start = time.perf_counter()
+    asyncio.run(dispatcher.run(events))
+    elapsed = time.perf_counter() - start
+    dispatcher.close()
+    bot.close()
+
+    return {
+        "events": len(events),
+        "elapsed": elapsed,
+        "timings": {step: sorted(values) for step, values in timings.items()},
+        "api_calls": dict(vk.calls),
+        "db_queries": db_queries[0],
+        "search_cache": vkinder.search_cache.stats(),
+    }
+
+
+def report(result):
+    """
+    Вывод результатов теста
+    :param result: Словарь с результатами
+    """
+    events = result["events"]
+    print(f"Событий: {events}, время: {result['elapsed']:.2f} с, "
+          f"событий/с: {events / result['elapsed']:.1f}")
+    print(f"{'шаг':<10}{'событий':>10}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for step, values in sorted(result["timings"].items()):
+        print(f"{step:<10}{len(values):>10}"
+              + "".join(f"{percentile(values, p) * 1000:>10.2f}" for p in (50, 95, 99)))
+    print("Вызовы API на событие:")
+    for name, count in sorted(result["api_calls"].items()):
+        print(f"  {name:<24}{count / events:.3f}")
+    print(f"Запросы к БД на событие: {result['db_queries'] / events:.3f}")
+    print(f"Кэш поиска: {result['search_cache']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест VKinder без обращения к VK")
+    parser.add_argument("--users", type=int, default=100, help="количество пользователей")
+    parser.add_argument("--rounds", type=int, default=20, help="действий каждого пользователя после поиска")
+    parser.add_argument("--latency", type=float, default=20, help="задержка ответа API, мс")
+    parser.add_argument("--concurrency", type=int, default=10, help="одновременно обрабатываемых пользователей")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля вызовов API, завершающихся ошибкой")
+    parser.add_argument("--db", default=None, help="строка подключения, по умолчанию временная база SQLite")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        connstr = args.db or f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+        report(run(args.users, args.rounds, args.latency / 1000, args.concurrency, connstr, args.error_rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Кэши, общие для всех пользователей бота
+"""
+
+import threading
+import time
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Потокобезопасный кэш ограниченного размера с вытеснением
+    давно не используемых записей (LRU) и временем жизни записей (TTL).
+    Устаревшие записи еще stale_ttl секунд доступны через get_stale.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, stale_ttl=0):
+        """
+        :param maxsize:   Максимальное количество записей
+        :param ttl:       Время жизни записи в секундах
+        :param stale_ttl: Сколько секунд после устаревания запись хранится для get_stale
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Счетчики для оценки эффективности кэша
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    def get(self, key, default=None):
+        """
+        Получение значения из кэша
+        :param key:     Ключ
+        :param default: Значение, если ключа нет или запись устарела
+        :return:        Значение из кэша
+        """
+        now = time.monotonic()
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or item[0] < now:
+                if item is not None and item[0] + self.stale_ttl < now:
+                    del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def get_stale(self, key, default=None):
+        """
+        Получение значения, в том числе устаревшего, но не старше stale_ttl.
+        Используется, когда получить свежие данные не удалось.
+        :param key:     Ключ
+        :param default: Значение, если записи нет
+        :return:        Значение из кэша
+        """
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or item[0] + self.stale_ttl < time.monotonic():
+                return default
+            self.stale_hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Сохранение значения в кэш
+        :param key:   Ключ
+        :param value: Значение
+        :param ttl:   Время жизни записи, по умолчанию - общее для кэша
+        """
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.data[key] = (expires, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        """
+        Очистка кэша и счетчиков
+        """
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.stale_hits = 0
+
+    def stats(self):
+        """
+        Статистика использования кэша
+        :return: Словарь с количеством попаданий, промахов и записей
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "stale_hits": self.stale_hits, "size": len(self.data)}
+
+    def __len__(self):
+        return len(self.data)
+
+
+class SeenIndex:
+    """
+    Компактное множество просмотренных анкет: отсортированный массив
+    беззнаковых 32-битных чисел с двоичным поиском (4 байта на запись)
+    """
+
+    __slots__ = ("items",)
+
+    def __init__(self, ids=()):
+        """
+        :param ids: Начальный набор id анкет
+        """
+        self.items = array("I", sorted(set(ids)))
+
+    def __contains__(self, candidate_id):
+        position = bisect_left(self.items, candidate_id)
+        return position < len(self.items) and self.items[position] == candidate_id
+
+    def add(self, candidate_id):
+        """
+        Добавление анкеты
+        :param candidate_id: Id анкеты
+        """
+        position = bisect_left(self.items, candidate_id)
+        if position == len(self.items) or self.items[position] != candidate_id:
+            self.items.insert(position, candidate_id)
+
+    def update(self, ids):
+        """
+        Добавление нескольких анкет
+        :param ids: Id анкет
+        """
+        new_ids = set(ids).difference(self.items)
+        if new_ids:
+            self.items = array("I", sorted(new_ids.union(self.items)))
+
+    def memory_usage(self):
+        """
+        Объем памяти, занимаемый индексом
+        :return: Размер в байтах
+        """
+        return self.items.buffer_info()[1] * self.items.itemsize
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
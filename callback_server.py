@@ -0,0 +1,236 @@
+"""
+Режим Callback API: VK присылает события POST-запросами на HTTP-сервер бота.
+
+Запуск:
+    python callback_server.py
+Проверка локально записанным событием:
+    curl -d @event.json http://127.0.0.1:8080/
+"""
+
+import asyncio
+import json
+import logging
+
+from http import HTTPStatus
+
+from cache import TTLCache
+from dispatcher import EventDispatcher, IncomingMessage
+from main import create_bot, start_crawler
+from metrics import registry, start_metrics_server
+from config import (CONCURRENCY, METRICS_PORT, INDEX_ENABLED, CALLBACK_HOST, CALLBACK_PORT, CALLBACK_CONFIRMATION,
+                    CALLBACK_SECRET, CALLBACK_GROUP_ID)
+
+# Максимальный размер тела запроса в байтах
+MAX_BODY_SIZE = 1024 * 1024
+# Сколько помнить обработанные event_id: VK повторяет событие, если не получил "ok"
+EVENT_ID_TTL = 3600
+EVENT_ID_LIMIT = 100000
+
+
+def parse_message(event):
+    """
+    Входящее сообщение из события Callback API
+    :param event: Событие (словарь из JSON)
+    :return:      IncomingMessage или None, если событие не нужно обрабатывать
+    """
+    if event.get("type") != "message_new":
+        return None
+    message = event.get("object", {}).get("message", {})
+    user_id = message.get("from_id", 0)
+    # Только текстовые сообщения от пользователей в личном диалоге с сообществом
+    if user_id <= 0 or message.get("peer_id") != user_id or message.get("out") or not message.get("text"):
+        return None
+    return IncomingMessage(user_id, message["text"])
+
+
+class CallbackServer:
+    """
+    Асинхронный HTTP-сервер Callback API. На каждое событие сразу отвечает "ok",
+    а обработку передает в очереди пользователей диспетчера.
+    """
+
+    def __init__(self, dispatcher, confirmation, secret=None, host="0.0.0.0", port=8080, group_id=0):
+        """
+        :param dispatcher:   Объект EventDispatcher
+        :param confirmation: Строка подтверждения адреса сервера из настроек сообщества
+        :param secret:       Секретный ключ из настроек сообщества, None - не проверять
+        :param host:         Адрес
+        :param port:         Порт
+        :param group_id:     Id сообщества для проверки запроса подтверждения, 0 - не проверять
+        """
+        self.dispatcher = dispatcher
+        self.confirmation = confirmation
+        self.secret = secret
+        self.group_id = group_id
+        self.host = host
+        self.port = port
+        self.logger = logging.getLogger(__name__)
+        self.seen = TTLCache(maxsize=EVENT_ID_LIMIT, ttl=EVENT_ID_TTL)
+        self.server = None
+
+        self.received = registry.counter("vkinder_callback_events_total", "События Callback API", ("type",))
+        self.duplicates = registry.counter("vkinder_callback_duplicates_total", "Повторно присланные события")
+
+    async def start(self):
+        """
+        Запуск сервера
+        """
+        self.dispatcher.start()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.logger.info(f"Callback API принимает события на {self.host}:{self.port}")
+
+    async def serve(self):
+        """
+        Запуск сервера и работа до отмены
+        """
+        await self.start()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            await self.dispatcher.join()
+
+    def handle_event(self, event):
+        """
+        Обработка события Callback API
+        :param event: Событие (словарь из JSON)
+        :return:      Кортеж (HTTP-статус, тело ответа)
+        """
+        event_type = event.get("type")
+        if event_type == "confirmation":
+            # В запросе подтверждения адреса VK может не передавать секретный ключ, он проверяется по id сообщества
+            if self.group_id and event.get("group_id") != self.group_id:
+                self.logger.warning(f"Запрос подтверждения от сообщества {event.get('group_id')}")
+                return HTTPStatus.FORBIDDEN, "forbidden"
+            self.received.inc(type=event_type)
+            return HTTPStatus.OK, self.confirmation
+        if self.secret is not None and event.get("secret") != self.secret:
+            self.logger.warning(f"Событие {event_type} с неверным секретным ключом")
+            return HTTPStatus.FORBIDDEN, "forbidden"
+        self.received.inc(type=event_type)
+
+        event_id = event.get("event_id")
+        if event_id is not None:
+            if self.seen.get(event_id) is not None:
+                self.duplicates.inc()
+                return HTTPStatus.OK, "ok"
+            self.seen.set(event_id, True)
+
+        message = parse_message(event)
+        if message is not None:
+            self.dispatcher.dispatch(message)
+        return HTTPStatus.OK, "ok"
+
+    async def handle_connection(self, reader, writer):
+        """
+        Обработка HTTP-соединения. Поддерживается keep-alive.
+        :param reader: Поток чтения
+        :param writer: Поток записи
+        """
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except ValueError:
+                    # Строка запроса или заголовок слишком длинные, неверный Content-Length
+                    await self.write_response(writer, HTTPStatus.BAD_REQUEST, "bad request", False)
+                    break
+                if request is None:
+                    break
+                method, headers, body = request
+                if method != "POST":
+                    status, text = HTTPStatus.METHOD_NOT_ALLOWED, "method not allowed"
+                elif body is None:
+                    status, text = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "too large"
+                else:
+                    try:
+                        event = json.loads(body)
+                    except ValueError:
+                        event = None
+                    if isinstance(event, dict):
+                        status, text = self.handle_event(event)
+                    else:
+                        status, text = HTTPStatus.BAD_REQUEST, "bad request"
+                keep_alive = headers.get("connection", "").lower() != "close" and body is not None
+                await self.write_response(writer, status, text, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        except Exception:
+            self.logger.exception("Ошибка при обработке запроса Callback API")
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_request(reader):
+        """
+        Чтение HTTP-запроса
+        :param reader: Поток чтения
+        :return:       Кортеж (метод, заголовки, тело) или None, если соединение закрыто.
+                       Тело None, если оно больше MAX_BODY_SIZE.
+        :raises ValueError: Запрос не удалось разобрать
+        """
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        method = line.decode("latin-1").split(" ", 1)[0].upper()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0) or 0)
+        if length < 0:
+            raise ValueError(f"Неверный Content-Length: {length}")
+        if length > MAX_BODY_SIZE:
+            return method, headers, None
+        body = await reader.readexactly(length) if length else b""
+        return method, headers, body
+
+    @staticmethod
+    async def write_response(writer, status, text, keep_alive):
+        """
+        Отправка HTTP-ответа
+        :param writer:     Поток записи
+        :param status:     HTTP-статус
+        :param text:       Тело ответа
+        :param keep_alive: Не закрывать соединение
+        """
+        body = text.encode()
+        head = (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                "Content-Type: text/plain; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+
+def main():
+    """
+    Запуск бота в режиме Callback API
+    """
+    bot = create_bot()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+        logging.info(f"Метрики доступны на порту {METRICS_PORT}")
+    crawler = start_crawler(bot.vkinder, bot.user_data) if INDEX_ENABLED else None
+
+    dispatcher = EventDispatcher(bot, concurrency=CONCURRENCY)
+    server = CallbackServer(dispatcher, CALLBACK_CONFIRMATION, CALLBACK_SECRET, CALLBACK_HOST, CALLBACK_PORT,
+                            CALLBACK_GROUP_ID)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        logging.info("Бот остановлен")
+    finally:
+        if crawler is not None:
+            crawler.stop()
+        dispatcher.close()
+        bot.close()
+
+
+if __name__ == "__main__":
+    main()
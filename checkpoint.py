@@ -0,0 +1,161 @@
+"""
+Контрольные точки для быстрого перезапуска: позиция Long Poll и снимок сессий
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from vk_api.longpoll import VkLongPoll
+
+# Заголовок файла снимка сессий: метка формата и время создания (unix)
+SNAPSHOT_MAGIC = b"VKS1"
+SNAPSHOT_HEADER = struct.Struct("<4sd")
+
+
+class CheckpointedLongPoll(VkLongPoll):
+    """
+    Long Poll, который помнит позицию, до которой все события уже переданы
+    обработчику, и помечает каждое событие позицией его пачки.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.committed_ts = self.ts
+
+    def listen(self):
+        """
+        Чтение событий. Атрибут checkpoint события - ts, с которого
+        нужно читать после перезапуска, чтобы получить это событие снова.
+        :return: Генератор событий
+        """
+        while True:
+            ts = self.ts
+            # Все события до ts уже отданы: следующий вызов generator.__next__ сделан после их обработки
+            self.committed_ts = ts
+            for event in self.check():
+                event.checkpoint = ts
+                yield event
+
+
+class Checkpoint:
+    """
+    Файлы контрольных точек в одном каталоге: позиция Long Poll
+    записывается периодически, снимок сессий - при остановке бота
+    """
+
+    def __init__(self, directory, interval=1.0):
+        """
+        :param directory: Каталог для файлов
+        :param interval:  Период записи позиции Long Poll в секундах
+        """
+        self.directory = directory
+        self.interval = interval
+        self.cursor_path = os.path.join(directory, "longpoll.json")
+        self.snapshot_path = os.path.join(directory, "sessions.bin")
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(directory, exist_ok=True)
+
+        self.position = None
+        self.saved = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def write(path, data):
+        """
+        Атомарная запись файла: сначала во временный, затем переименование
+        :param path: Путь к файлу
+        :param data: Содержимое
+        """
+        temp = f"{path}.tmp"
+        with open(temp, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, path)
+
+    def load_cursor(self):
+        """
+        Сохраненная позиция Long Poll
+        :return: ts или None, если позиции нет
+        """
+        try:
+            with open(self.cursor_path) as file:
+                return json.load(file)["ts"]
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError) as error:
+            self.logger.error(f"Поврежден файл позиции Long Poll: {error}")
+            return None
+
+    def save_cursor(self, ts):
+        """
+        Запись позиции Long Poll, если она изменилась
+        :param ts: Позиция
+        """
+        if ts is None or ts == self.saved:
+            return
+        self.write(self.cursor_path, json.dumps({"ts": ts, "saved_at": time.time()}).encode())
+        self.saved = ts
+
+    def start(self, position):
+        """
+        Периодическая запись позиции Long Poll в фоновом потоке
+        :param position: Функция, возвращающая текущую безопасную позицию
+        """
+        self.position = position
+        self.thread = threading.Thread(target=self.run, name="checkpoint", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.save_cursor(self.position())
+            except Exception as error:
+                self.logger.error(f"Ошибка при записи позиции Long Poll: {error}")
+
+    def stop(self):
+        """
+        Остановка фоновой записи и запись последней позиции
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.save_cursor(self.position())
+
+    def save_sessions(self, snapshot):
+        """
+        Запись снимка сессий: JSON, сжатый zlib, с заголовком
+        :param snapshot: Результат SessionStore.snapshot()
+        """
+        body = zlib.compress(json.dumps(snapshot, separators=(",", ":"), ensure_ascii=False).encode(), 1)
+        self.write(self.snapshot_path, SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, time.time()) + body)
+
+    def load_sessions(self, max_age):
+        """
+        Чтение снимка сессий. Файл отображается в память, после чтения удаляется,
+        чтобы при следующем запуске не восстановить устаревшие сессии.
+        :param max_age: Максимальный возраст снимка в секундах
+        :return:        Снимок или пустой список
+        """
+        try:
+            with open(self.snapshot_path, "rb") as file, \
+                    mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                magic, created = SNAPSHOT_HEADER.unpack_from(data)
+                if magic != SNAPSHOT_MAGIC or time.time() - created > max_age:
+                    return []
+                return json.loads(zlib.decompress(data[SNAPSHOT_HEADER.size:]))
+        except FileNotFoundError:
+            return []
+        except (ValueError, struct.error, zlib.error) as error:
+            self.logger.error(f"Поврежден файл снимка сессий: {error}")
+            return []
+        finally:
+            if os.path.exists(self.snapshot_path):
+                os.remove(self.snapshot_path)
@@ -12,10 +12,98 @@ if len(config.read("settings.ini")) == 0:
     exit()
 
 # Токен пользователя
-USER_TOKEN = config.get("settings", "user_token")
+USER_TOKEN = config.get("settings", "user_token", fallback="")
+# Пул токенов пользователей через запятую, по умолчанию - один user_token
+USER_TOKENS = [token.strip() for token in config.get("settings", "user_tokens", fallback=USER_TOKEN).split(",")
+               if token.strip()]
+# Количество запросов в секунду на один токен пользователя
+USER_TOKEN_RATE = config.getint("settings", "user_token_rate", fallback=3)
 # Токен группы
 GROUP_TOKEN = config.get("settings", "group_token")
 # Файл для логгирования
 LOGGING_FILE = config.get("settings", "logging_file")
 # База данных
 CONNSTR = config.get("database", "connstr")
+# Пул соединений с базой данных: постоянные соединения, дополнительные соединения, ожидание соединения (сек.)
+POOL_SIZE = config.getint("database", "pool_size", fallback=10)
+MAX_OVERFLOW = config.getint("database", "max_overflow", fallback=10)
+POOL_TIMEOUT = config.getint("database", "pool_timeout", fallback=30)
+# Отложенная запись показанных анкет и избранного: включена, период записи (мс), размер пачки
+WRITE_BEHIND = config.getboolean("database", "write_behind", fallback=True)
+FLUSH_INTERVAL = config.getint("database", "flush_interval_ms", fallback=200) / 1000
+FLUSH_SIZE = config.getint("database", "flush_size", fallback=500)
+# Количество пользователей, обрабатываемых одновременно
+CONCURRENCY = config.getint("settings", "concurrency", fallback=10)
+# Кэш результатов поиска: количество записей и время жизни в секундах
+SEARCH_CACHE_SIZE = config.getint("cache", "search_size", fallback=1024)
+SEARCH_CACHE_TTL = config.getint("cache", "search_ttl", fallback=600)
+# Максимальное количество отправляемых сообщений в секунду
+SEND_RATE = config.getint("settings", "send_rate", fallback=20)
+# Сессии пользователей: количество в памяти, время бездействия до выгрузки в базу (сек.), лимит памяти (Мб)
+SESSION_LIMIT = config.getint("sessions", "limit", fallback=10000)
+SESSION_IDLE = config.getint("sessions", "idle", fallback=3600)
+SESSION_MEMORY = config.getint("sessions", "memory_mb", fallback=256) * 1024 * 1024
+# Количество анкет в буфере, при котором загружается следующая страница поиска
+LOW_WATER_MARK = config.getint("settings", "low_water_mark", fallback=10)
+# Количество потоков фоновой загрузки анкет
+PREFETCH_WORKERS = config.getint("settings", "prefetch_workers", fallback=4)
+# Порт HTTP-сервера метрик Prometheus (0 - не запускать)
+METRICS_PORT = config.getint("metrics", "port", fallback=0)
+# Доля сообщений, обработка которых профилируется (от 0 до 1)
+PROFILE_RATE = config.getfloat("metrics", "profile_rate", fallback=0.0)
+# Режим работы: async - один процесс, sharded - несколько процессов-обработчиков
+MODE = config.get("settings", "mode", fallback="async")
+# Количество процессов-обработчиков в режиме sharded
+WORKERS = config.getint("settings", "workers", fallback=4)
+# Локальный индекс анкет, заполняемый фоновым обходчиком
+INDEX_ENABLED = config.getboolean("crawler", "enabled", fallback=False)
+# В режиме sharded у каждого процесса свои очередь отправки и пул токенов, поэтому общие лимиты делятся:
+# отправка - между обработчиками, запросы по токенам пользователей - еще и с обходчиком в главном процессе
+if MODE == "sharded":
+    SEND_RATE /= WORKERS
+    USER_TOKEN_RATE /= WORKERS + (1 if INDEX_ENABLED else 0)
+# Города для обхода через запятую
+CRAWLER_CITIES = [int(city) for city in config.get("crawler", "cities", fallback="1,2").split(",") if city.strip()]
+# Семейные положения для обхода через запятую
+CRAWLER_STATUSES = [int(status) for status in config.get("crawler", "statuses", fallback="1,2,3,4,5").split(",")
+                    if status.strip()]
+# Период обновления набора критериев в индексе (сек.)
+CRAWLER_REFRESH = config.getint("crawler", "refresh", fallback=86400)
+# Максимальный возраст индекса, при котором он используется для поиска (сек.)
+INDEX_MAX_AGE = config.getint("crawler", "max_age", fallback=2 * CRAWLER_REFRESH)
+# Кэш топ-фото анкет: количество записей, время жизни (сек.), время жизни записи "фото нет" (сек.)
+PHOTO_CACHE_SIZE = config.getint("cache", "photo_size", fallback=50000)
+PHOTO_CACHE_TTL = config.getint("cache", "photo_ttl", fallback=86400)
+PHOTO_NEGATIVE_TTL = config.getint("cache", "photo_negative_ttl", fallback=3600)
+# Хранить кэш фото в базе данных, чтобы он переживал перезапуск
+PHOTO_CACHE_PERSISTENT = config.getboolean("cache", "photo_persistent", fallback=False)
+# Максимальное количество просматриваемых страниц альбома (по 200 фото) при выборе топ-фото
+PHOTO_MAX_PAGES = config.getint("cache", "photo_max_pages", fallback=3)
+# Веса признаков ранжирования анкет (раздел [ranking], например: recency = 3.0)
+RANKING_WEIGHTS = {key: float(value) for key, value in config.items("ranking")} if config.has_section("ranking") else {}
+# Режим Callback API: адрес и порт сервера, строка подтверждения, секретный ключ и id сообщества
+# (0 - подтверждение для любого сообщества) из настроек сообщества
+CALLBACK_HOST = config.get("callback", "host", fallback="0.0.0.0")
+CALLBACK_PORT = config.getint("callback", "port", fallback=8080)
+CALLBACK_CONFIRMATION = config.get("callback", "confirmation", fallback="")
+CALLBACK_SECRET = config.get("callback", "secret", fallback="") or None
+CALLBACK_GROUP_ID = config.getint("callback", "group_id", fallback=0)
+# Контрольные точки для быстрого перезапуска: каталог (пустой - отключено), период записи позиции Long Poll (сек.),
+# максимальный возраст снимка сессий, при котором он восстанавливается (сек.)
+CHECKPOINT_DIR = config.get("checkpoint", "dir", fallback="checkpoint")
+CHECKPOINT_INTERVAL = config.getfloat("checkpoint", "interval", fallback=1.0)
+SNAPSHOT_MAX_AGE = config.getint("checkpoint", "snapshot_max_age", fallback=600)
+# Ограничение повторяющихся предупреждений и ошибок из одного места кода: записей в секунду (0 - без ограничения)
+# и максимальное количество записей подряд
+LOG_RATE = config.getfloat("logging", "rate", fallback=1.0)
+LOG_BURST = config.getint("logging", "burst", fallback=10)
+# Устойчивость вызовов API VK: срок выполнения вызова с повторами (сек.), сроки по методам (раздел [deadlines],
+# например: users.search = 5), количество повторов при временных ошибках, количество ошибок подряд до размыкания цепи,
+# время до пробного вызова (сек.), сколько хранить устаревшие результаты поиска и фото на случай сбоя VK (сек.)
+VK_DEADLINE = config.getfloat("resilience", "deadline", fallback=10.0)
+VK_DEADLINES = {method: float(value) for method, value in config.items("deadlines")} \
+    if config.has_section("deadlines") else {}
+VK_RETRIES = config.getint("resilience", "retries", fallback=2)
+CIRCUIT_THRESHOLD = config.getint("resilience", "failure_threshold", fallback=5)
+CIRCUIT_RESET = config.getfloat("resilience", "reset_timeout", fallback=30.0)
+STALE_TTL = config.getint("resilience", "stale_ttl", fallback=86400)
@@ -0,0 +1,107 @@
+"""
+Фоновый обходчик, заполняющий локальный индекс анкет
+"""
+
+import logging
+import threading
+
+from datetime import datetime, timedelta
+from itertools import product
+
+from search_planner import SEARCH_LIMIT
+
+
+class CandidateCrawler:
+    """
+    Обход пространства критериев (возраст, пол, город, семейное положение)
+    с сохранением открытых анкет в локальный индекс. Сначала обходятся
+    критерии, которых нет в индексе, затем - самые давно обновленные.
+    """
+
+    def __init__(self, vkinder, saver, cities, statuses=(1, 2, 3, 4, 5), ages=range(13, 100),
+                 sexes=(1, 2), refresh=86400, pause=1.0):
+        """
+        :param vkinder:  Объект VKinder
+        :param saver:    Объект Saver
+        :param cities:   Id городов
+        :param statuses: Семейные положения
+        :param ages:     Возрасты
+        :param sexes:    Пол
+        :param refresh:  Период обновления набора критериев в секундах
+        :param pause:    Пауза между запросами в секундах
+        """
+        self.vkinder = vkinder
+        self.saver = saver
+        self.space = list(product(ages, sexes, cities, statuses))
+        self.refresh = refresh
+        self.pause = pause
+        self.logger = logging.getLogger(__name__)
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Запуск обхода в фоновом потоке
+        """
+        self.thread = threading.Thread(target=self.run, name="crawler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Остановка обхода
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def stale_criteria(self):
+        """
+        Наборы критериев, которые нужно обновить, начиная с самых старых
+        :return: Список кортежей (возраст, пол, город, положение)
+        """
+        crawled = self.saver.get_crawl_times()
+        deadline = datetime.utcnow() - timedelta(seconds=self.refresh)
+        stale = [key for key in self.space if crawled.get(key, datetime.min) < deadline]
+        return sorted(stale, key=lambda key: crawled.get(key, datetime.min))
+
+    def crawl(self, age, gender, city, status):
+        """
+        Обновление индекса для одного набора критериев
+        :param age:    Возраст
+        :param gender: Пол
+        :param city:   Город
+        :param status: Семейное положение
+        :return:       True при успехе
+        """
+        result = self.vkinder.search_page(age, gender, city, status, count=SEARCH_LIMIT, use_cache=False)
+        if result is None:
+            return False
+        users, total = result
+        # Общее количество нужно планировщику поиска: по нему видно, помещаются ли результаты в один запрос
+        self.saver.save_candidates(age, gender, city, status,
+                                   [user for user in users if not user.get('is_closed', True)], total)
+        return True
+
+    def run(self):
+        """
+        Цикл обхода
+        """
+        while not self.stopped.is_set():
+            try:
+                stale = self.stale_criteria()
+            except Exception as error:
+                self.logger.error(f"Ошибка при чтении состояния индекса: {error}")
+                stale = []
+            if not stale:
+                # Все критерии свежие: проверяем снова через десятую часть периода
+                self.stopped.wait(self.refresh / 10)
+                continue
+            for criteria in stale:
+                if self.stopped.is_set():
+                    return
+                try:
+                    self.crawl(*criteria)
+                except Exception as error:
+                    self.logger.error(f"Ошибка при обходе критериев {criteria}: {error}")
+                self.stopped.wait(self.pause)
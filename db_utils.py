@@ -1,73 +1,573 @@
 import logging
-import sys
+import threading
+import time
 
-from sqlalchemy import create_engine, Column, Integer, ARRAY, inspect
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import (create_engine, make_url, Column, Integer, String, DateTime, JSON, ARRAY, inspect, func,
+                        select, delete, text, or_)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from metrics import timed, DB_SECONDS, DB_ERRORS, DB_POOL_WAIT_SECONDS
+
 Base = declarative_base()
 
+# Размер пачки при переносе данных из старой таблицы
+MIGRATION_BATCH = 10000
+# Ключ блокировки PostgreSQL на время создания схемы
+SCHEMA_LOCK_KEY = 0x564B696E
+# Отметка о переносе данных из старой таблицы в таблице schema_migrations
+LEGACY_MIGRATION = 'shown_candidates_from_new_users_2'
+
 
 class User(Base):
+    """
+    Старая схема: все просмотренные анкеты пользователя в одном массиве.
+    Используется только для миграции.
+    """
     __tablename__ = 'new_users_2'
 
     user_id = Column(Integer, primary_key=True)
     searched_users = Column(ARRAY(Integer), nullable=False)
 
 
+class ShownCandidate(Base):
+    """
+    Анкета, показанная пользователю
+    """
+    __tablename__ = 'shown_candidates'
+
+    user_id = Column(Integer, primary_key=True)
+    candidate_id = Column(Integer, primary_key=True)
+    shown_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
+class Favorite(Base):
+    """
+    Анкета, добавленная пользователем в избранное
+    """
+    __tablename__ = 'favorites'
+
+    user_id = Column(Integer, primary_key=True)
+    candidate_id = Column(Integer, primary_key=True)
+    added_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
+class UserState(Base):
+    """
+    Состояние диалога, выгруженное из памяти бота
+    """
+    __tablename__ = 'user_sessions'
+
+    user_id = Column(Integer, primary_key=True)
+    state = Column(JSON, nullable=False)
+    updated_at = Column(DateTime, nullable=False, server_default=func.now(), onupdate=func.now())
+
+
+class SchemaMigration(Base):
+    """
+    Отметка о выполненном переносе данных
+    """
+    __tablename__ = 'schema_migrations'
+
+    name = Column(String, primary_key=True)
+    applied_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
+class Candidate(Base):
+    """
+    Анкета из локального индекса, собранного фоновым обходчиком
+    """
+    __tablename__ = 'candidates'
+
+    city = Column(Integer, primary_key=True)
+    sex = Column(Integer, primary_key=True)
+    age = Column(Integer, primary_key=True)
+    status = Column(Integer, primary_key=True)
+    candidate_id = Column(Integer, primary_key=True)
+    photo_id = Column(String)
+    # Поля users.search для ранжирования (ranking.SEARCH_FIELDS), last_seen - время визита (unix)
+    has_photo = Column(Integer)
+    online = Column(Integer)
+    last_seen = Column(Integer)
+    interests = Column(String)
+    relation = Column(Integer)
+
+
+class CrawlState(Base):
+    """
+    Время последнего обновления индекса для набора критериев
+    """
+    __tablename__ = 'crawl_state'
+
+    city = Column(Integer, primary_key=True)
+    sex = Column(Integer, primary_key=True)
+    age = Column(Integer, primary_key=True)
+    status = Column(Integer, primary_key=True)
+    refreshed_at = Column(DateTime, nullable=False)
+    total = Column(Integer, nullable=False)
+
+
+class PhotoCacheEntry(Base):
+    """
+    Вложения топ-фото анкеты (пустая строка - фото нет или альбом закрыт)
+    """
+    __tablename__ = 'photo_cache'
+
+    candidate_id = Column(Integer, primary_key=True)
+    top_count = Column(Integer, primary_key=True)
+    attachments = Column(String, nullable=False)
+    cached_at = Column(DateTime, nullable=False)
+
+
+# Поля ранжирования в индексе анкет: добавляются в индекс, созданный до их появления
+RANKING_COLUMNS = ['has_photo', 'online', 'last_seen', 'interests', 'relation']
+
+# Таблицы текущей схемы
+TABLES = [ShownCandidate.__table__, Favorite.__table__, UserState.__table__, SchemaMigration.__table__,
+          Candidate.__table__, CrawlState.__table__, PhotoCacheEntry.__table__]
+
+
 class Saver:
-    def __init__(self, connstr=None):
+    def __init__(self, connstr=None, pool_size=10, max_overflow=10, pool_timeout=30,
+                 write_behind=False, flush_interval=0.2, flush_size=500):
+        """
+        :param connstr:        Строка подключения к базе данных.
+        :param pool_size:      Количество постоянных соединений в пуле.
+        :param max_overflow:   Количество дополнительных соединений сверх pool_size.
+        :param pool_timeout:   Время ожидания свободного соединения в секундах.
+        :param write_behind:   Копить показанные анкеты и избранное в памяти и записывать пачками.
+        :param flush_interval: Период записи пачки в секундах.
+        :param flush_size:     Количество записей, при котором пачка записывается сразу.
+        """
         self.logger = logging.getLogger(__name__)
-        self.engine = create_engine(connstr)
-        self.Session = sessionmaker(bind=self.engine)
-        self.session = self.Session()
+        self.engine = create_engine(connstr, **self.pool_options(connstr, pool_size, max_overflow, pool_timeout))
+        # Каждая операция работает в своей сессии со своим соединением из пула
+        self.Session = sessionmaker()
         self.table_check()
 
-    def table_create(self):
+        # Буфер отложенной записи: ожидающие записи и записываемые прямо сейчас
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.pending = self.new_buffer()
+        self.flushing = self.new_buffer()
+        self.pending_count = 0
+        self.buffer = threading.Condition()
+        self.stopped = False
+        self.flusher = None
+        if write_behind:
+            self.flusher = threading.Thread(target=self.run_flusher, name="saver-flusher", daemon=True)
+            self.flusher.start()
+
+    @staticmethod
+    def pool_options(connstr, pool_size, max_overflow, pool_timeout):
+        """
+        Параметры пула соединений для create_engine.
+        :param connstr:      Строка подключения.
+        :param pool_size:    Количество постоянных соединений.
+        :param max_overflow: Количество дополнительных соединений.
+        :param pool_timeout: Время ожидания соединения в секундах.
+        :return:             Словарь параметров.
+        """
+        url = make_url(connstr)
+        if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+            # База SQLite в памяти живет в одном соединении, пул не настраивается
+            return {}
+        return {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_timeout': pool_timeout,
+                'pool_pre_ping': True}
+
+    def insert(self, model):
+        """
+        Конструкция INSERT с поддержкой ON CONFLICT для текущей СУБД.
+        :param model: Модель таблицы.
+        :return:      Объект Insert.
+        """
+        if self.engine.dialect.name == 'sqlite':
+            return sqlite.insert(model)
+        return postgresql.insert(model)
+
+    @contextmanager
+    def session_scope(self):
         """
-        Создание таблицы, если она не существует.
+        Сессия на одну операцию: соединение берется из пула, транзакция
+        фиксируется при успехе и откатывается при ошибке.
+        Время ожидания соединения учитывается в метрике vkinder_db_pool_wait_seconds.
         """
-        Base.metadata.create_all(self.engine)
+        start = time.perf_counter()
+        connection = self.engine.connect()
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+        session = self.Session(bind=connection)
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+            connection.close()
+
+    def connections_in_use(self):
+        """
+        Количество соединений, выданных из пула.
+        :return: Число соединений.
+        """
+        checkedout = getattr(self.engine.pool, 'checkedout', None)
+        return checkedout() if checkedout is not None else 0
 
     def table_check(self):
         """
-        Проверка существования таблицы, создание при необходимости.
+        Создание недостающих таблиц и перенос данных из старой схемы.
+        Безопасно при повторном запуске и при одновременном запуске нескольких обработчиков.
+        """
+        with self.engine.begin() as connection:
+            if self.engine.dialect.name == 'postgresql':
+                # Обработчики, стартующие одновременно, создают схему по очереди
+                connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': SCHEMA_LOCK_KEY})
+            inspector = inspect(connection)
+            missing = [table.name for table in TABLES if not inspector.has_table(table.name)]
+            if missing:
+                Base.metadata.create_all(connection, tables=TABLES)
+                self.logger.info(f'Созданы таблицы: {", ".join(missing)}')
+            self.migrate_candidates(connection, inspector)
+            if inspector.has_table(User.__tablename__):
+                self.migrate_legacy(connection)
+
+    def migrate_candidates(self, connection, inspector):
+        """
+        Добавление полей ранжирования в таблицу индекса анкет старой схемы.
+        Индекс без этих полей удаляется, обходчик соберет его заново.
+        :param connection: Соединение с открытой транзакцией.
+        :param inspector:  Инспектор схемы базы данных.
         """
-        inspector = inspect(self.engine)
-        if not inspector.has_table(User.__tablename__):
-            response = input('Таблицы не существует. Создать таблицу? (Y/N): ').upper()
-            if response == 'Y':
-                self.table_create()
-                self.logger.info('Таблица создана.')
-            else:
-                self.logger.info('Выход...')
-                sys.exit(0)
+        table = Candidate.__table__
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        added = [name for name in RANKING_COLUMNS if name not in columns]
+        for name in added:
+            column_type = table.columns[name].type.compile(dialect=self.engine.dialect)
+            connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {name} {column_type}'))
+        if added:
+            connection.execute(delete(Candidate))
+            connection.execute(delete(CrawlState))
+            self.logger.info(f'В индекс анкет добавлены поля: {", ".join(added)}. Индекс будет собран заново')
+
+    @timed(DB_SECONDS, DB_ERRORS, operation='migrate_legacy')
+    def migrate_legacy(self, connection):
+        """
+        Перенос просмотренных анкет из массивов старой таблицы в новую.
+        Старая таблица не изменяется: перенос отмечается в schema_migrations,
+        поэтому повторный запуск ничего не делает.
+        :param connection: Соединение с открытой транзакцией.
+        """
+        if connection.scalar(select(SchemaMigration.name).where(SchemaMigration.name == LEGACY_MIGRATION)):
+            return
+        users = connection.execute(select(User.user_id, User.searched_users)).all()
+        values = [{'user_id': user_id, 'candidate_id': candidate_id}
+                  for user_id, searched_users in users for candidate_id in set(searched_users or [])]
+        for start in range(0, len(values), MIGRATION_BATCH):
+            connection.execute(self.insert(ShownCandidate).on_conflict_do_nothing(),
+                               values[start:start + MIGRATION_BATCH])
+        connection.execute(self.insert(SchemaMigration).values(name=LEGACY_MIGRATION).on_conflict_do_nothing())
+        self.logger.info(f'Перенесено анкет из старой таблицы {User.__tablename__}: {len(values)}. '
+                         f'Старую таблицу можно удалить после проверки')
 
     def save_session_to_db(self, user_id, searched_users):
         """
-        Сохраняет или обновляет сессию пользователя в базе данных.
+        Сохраняет показанные пользователю анкеты в базе данных.
+        Уже сохраненные анкеты пропускаются.
         :param user_id:          ID пользователя ВКонтакте.
-        :param searched_users:   Найденный пользователь.
+        :param searched_users:   Список ID показанных анкет.
         """
-        user = self.session.query(User).get(user_id)
-        if user:
-            user.searched_users = user.searched_users + searched_users
-            self.session.merge(user)
-        else:
-            user = User(user_id=user_id, searched_users=searched_users)
-            self.session.add(user)
+        if searched_users:
+            self.buffer_write('shown', user_id, searched_users)
 
-        self.session.flush()
-        self.session.commit()
+    def add_favorite(self, user_id, candidate_id):
+        """
+        Добавляет анкету в избранное пользователя.
+        :param user_id:      ID пользователя ВКонтакте.
+        :param candidate_id: ID анкеты.
+        """
+        self.buffer_write('favorites', user_id, [candidate_id])
 
-    def get_user_data_from_db(self, user_id):
+    @timed(DB_SECONDS, DB_ERRORS, operation='get_favorites')
+    def get_favorites(self, user_id):
+        """
+        Извлекает избранное пользователя.
+        :param user_id: ID пользователя.
+        :return:        Список ID анкет в порядке добавления.
+        """
+        with self.buffer:
+            buffered = self.flushing['favorites'].get(user_id, []) + self.pending['favorites'].get(user_id, [])
+        query = select(Favorite.candidate_id).where(Favorite.user_id == user_id).order_by(Favorite.added_at)
+        with self.session_scope() as session:
+            stored = list(session.scalars(query))
+        return stored + [candidate_id for candidate_id in buffered if candidate_id not in stored]
+
+    @staticmethod
+    def new_buffer():
+        """
+        Пустой буфер отложенной записи.
+        :return: Словарь {вид записи: {ID пользователя: список ID анкет}}.
+        """
+        return {'shown': defaultdict(list), 'favorites': defaultdict(list)}
+
+    def buffer_write(self, kind, user_id, candidate_ids):
+        """
+        Запись анкет пользователя: сразу или через буфер отложенной записи.
+        :param kind:          Вид записи: 'shown' или 'favorites'.
+        :param user_id:       ID пользователя.
+        :param candidate_ids: Список ID анкет.
+        """
+        if not self.write_behind:
+            buffer = self.new_buffer()
+            buffer[kind][user_id].extend(candidate_ids)
+            self.write_buffer(buffer)
+            return
+        with self.buffer:
+            self.pending[kind][user_id].extend(candidate_ids)
+            self.pending_count += len(candidate_ids)
+            if self.pending_count >= self.flush_size:
+                self.buffer.notify()
+
+    @timed(DB_SECONDS, DB_ERRORS, operation='write_buffer')
+    def write_buffer(self, buffer):
+        """
+        Запись буфера одной транзакцией.
+        :param buffer: Буфер отложенной записи.
+        """
+        shown = [{'user_id': user_id, 'candidate_id': candidate_id}
+                 for user_id, candidate_ids in buffer['shown'].items() for candidate_id in candidate_ids]
+        favorites = [{'user_id': user_id, 'candidate_id': candidate_id}
+                     for user_id, candidate_ids in buffer['favorites'].items() for candidate_id in candidate_ids]
+        with self.session_scope() as session:
+            if shown:
+                session.execute(self.insert(ShownCandidate).on_conflict_do_nothing(), shown)
+            if favorites:
+                session.execute(self.insert(Favorite).on_conflict_do_nothing(), favorites)
+
+    def flush(self):
+        """
+        Запись всех ожидающих записей из буфера отложенной записи.
+        При ошибке записи возвращаются в буфер.
+        """
+        with self.buffer:
+            if not self.pending_count:
+                return
+            self.flushing, self.pending = self.pending, self.new_buffer()
+            self.pending_count = 0
+        try:
+            self.write_buffer(self.flushing)
+        except Exception as error:
+            self.logger.error(f'Ошибка при записи буфера в базу данных: {error}')
+            with self.buffer:
+                for kind, users in self.flushing.items():
+                    for user_id, candidate_ids in users.items():
+                        self.pending[kind][user_id][:0] = candidate_ids
+                        self.pending_count += len(candidate_ids)
+        finally:
+            with self.buffer:
+                self.flushing = self.new_buffer()
+
+    def run_flusher(self):
+        """
+        Периодическая запись буфера отложенной записи.
+        """
+        while True:
+            with self.buffer:
+                if not self.stopped and self.pending_count < self.flush_size:
+                    self.buffer.wait(self.flush_interval)
+                stopped = self.stopped
+            self.flush()
+            if stopped:
+                return
+
+    def close(self):
+        """
+        Завершение работы: запись оставшихся данных буфера.
+        """
+        with self.buffer:
+            self.stopped = True
+            self.buffer.notify()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
+
+    @timed(DB_SECONDS, DB_ERRORS, operation='get_user_data_from_db')
+    def get_user_data_from_db(self, user_id, candidate_ids=None):
         """
         Извлекает данные о пользователе из базы данных.
+        :param user_id:       ID пользователя.
+        :param candidate_ids: Если указан, проверяются только эти анкеты.
+        :return:              Список показанных пользователю анкет.
+        """
+        # Буфер читается до запроса к базе: запись, ушедшая из буфера, к этому моменту уже сохранена
+        with self.buffer:
+            buffered = set(self.flushing['shown'].get(user_id, []) + self.pending['shown'].get(user_id, []))
+        if candidate_ids is not None:
+            buffered.intersection_update(candidate_ids)
+
+        query = select(ShownCandidate.candidate_id).where(ShownCandidate.user_id == user_id)
+        if candidate_ids is not None:
+            query = query.where(ShownCandidate.candidate_id.in_(candidate_ids))
+        with self.session_scope() as session:
+            stored = list(session.scalars(query))
+        return stored + list(buffered.difference(stored))
+
+    def is_shown(self, user_id, candidate_id):
+        """
+        Проверка, показывалась ли анкета пользователю.
+        :param user_id:      ID пользователя.
+        :param candidate_id: ID анкеты.
+        :return:             True, если анкета уже показывалась.
+        """
+        return bool(self.get_user_data_from_db(user_id, [candidate_id]))
+
+    @timed(DB_SECONDS, DB_ERRORS, operation='save_session_state')
+    def save_session_state(self, user_id, state):
+        """
+        Сохраняет состояние диалога пользователя.
+        :param user_id: ID пользователя.
+        :param state:   Словарь с состоянием.
+        """
+        statement = self.insert(UserState).values(user_id=user_id, state=state)
+        statement = statement.on_conflict_do_update(
+            index_elements=[UserState.user_id],
+            set_={'state': statement.excluded.state, 'updated_at': func.now()},
+        )
+        with self.session_scope() as session:
+            session.execute(statement)
+
+    @timed(DB_SECONDS, DB_ERRORS, operation='load_session_state')
+    def load_session_state(self, user_id):
+        """
+        Загружает сохраненное состояние диалога пользователя.
         :param user_id: ID пользователя.
-        :return:        Список найденных пользователей, либо None.
+        :return:        Словарь с состоянием, либо None.
+        """
+        with self.session_scope() as session:
+            return session.scalar(select(UserState.state).where(UserState.user_id == user_id))
+
+    @timed(DB_SECONDS, DB_ERRORS, operation='save_candidates')
+    def save_candidates(self, age, gender, city, status, users, total=None):
+        """
+        Замена анкет в локальном индексе для набора критериев.
+        :param age:    Возраст.
+        :param gender: Пол.
+        :param city:   Город.
+        :param status: Семейное положение.
+        :param users:  Открытые анкеты из users.search с полями ранжирования.
+        :param total:  Общее количество найденных анкет (поле count ответа users.search).
+        """
+        key = {'age': int(age), 'sex': int(gender), 'city': int(city), 'status': int(status)}
+        values = [dict(key, candidate_id=user['id'], photo_id=user.get('photo_id'), has_photo=user.get('has_photo'),
+                       online=user.get('online'), last_seen=(user.get('last_seen') or {}).get('time'),
+                       interests=user.get('interests'), relation=user.get('relation'))
+                  for user in users]
+        total = len(values) if total is None else total
+        state = self.insert(CrawlState).values(**key, refreshed_at=datetime.utcnow(), total=total)
+        state = state.on_conflict_do_update(
+            index_elements=[CrawlState.city, CrawlState.sex, CrawlState.age, CrawlState.status],
+            set_={'refreshed_at': state.excluded.refreshed_at, 'total': state.excluded.total},
+        )
+        with self.session_scope() as session:
+            session.execute(delete(Candidate).filter_by(**key))
+            if values:
+                session.execute(self.insert(Candidate).on_conflict_do_nothing(), values)
+            session.execute(state)
+
+    @timed(DB_SECONDS, DB_ERRORS, operation='get_candidates')
+    def get_candidates(self, age, gender, city, status, count, offset, max_age):
+        """
+        Страница анкет из локального индекса.
+        :param age:     Возраст.
+        :param gender:  Пол.
+        :param city:    Город.
+        :param status:  Семейное положение.
+        :param count:   Количество анкет.
+        :param offset:  Смещение.
+        :param max_age: Максимальный возраст индекса в секундах.
+        :return:        Кортеж (список анкет в формате users.search с полями ранжирования,
+                        общее количество найденных VK анкет), либо None, если индекса нет или он устарел.
+        """
+        key = {'age': int(age), 'sex': int(gender), 'city': int(city), 'status': int(status)}
+        query = (select(Candidate.candidate_id, Candidate.photo_id, *[Candidate.__table__.columns[name]
+                                                                      for name in RANKING_COLUMNS])
+                 .filter_by(**key).order_by(Candidate.candidate_id).offset(offset).limit(count))
+        with self.session_scope() as session:
+            state = session.execute(select(CrawlState.refreshed_at, CrawlState.total).filter_by(**key)).first()
+            if state is None or state.refreshed_at < datetime.utcnow() - timedelta(seconds=max_age):
+                return None
+            rows = session.execute(query).all()
+        return [self.candidate_from_row(row) for row in rows], state.total
+
+    @staticmethod
+    def candidate_from_row(row):
+        """
+        Анкета индекса в формате users.search. Поля, которых не было в ответе VK, не добавляются.
+        :param row: Строка таблицы candidates.
+        :return:    Словарь анкеты.
+        """
+        user = {'id': row.candidate_id, 'photo_id': row.photo_id, 'is_closed': False}
+        for name in RANKING_COLUMNS:
+            value = getattr(row, name)
+            if value is not None:
+                user[name] = {'time': value} if name == 'last_seen' else value
+        return user
+
+    @timed(DB_SECONDS, DB_ERRORS, operation='get_crawl_times')
+    def get_crawl_times(self):
+        """
+        Время последнего обновления индекса по наборам критериев.
+        :return: Словарь {(возраст, пол, город, положение): время обновления}.
+        """
+        query = select(CrawlState.age, CrawlState.sex, CrawlState.city, CrawlState.status, CrawlState.refreshed_at)
+        with self.session_scope() as session:
+            rows = session.execute(query).all()
+        return {(age, sex, city, status): refreshed_at for age, sex, city, status, refreshed_at in rows}
+
+    @timed(DB_SECONDS, DB_ERRORS, operation='save_photos')
+    def save_photos(self, photos, top_count):
+        """
+        Сохраняет вложения топ-фото анкет.
+        :param photos:    Словарь {ID анкеты: список вложений}.
+        :param top_count: Количество фото.
+        """
+        cached_at = datetime.utcnow()
+        values = [{'candidate_id': candidate_id, 'top_count': top_count,
+                   'attachments': ','.join(attachments), 'cached_at': cached_at}
+                  for candidate_id, attachments in photos.items()]
+        statement = self.insert(PhotoCacheEntry)
+        statement = statement.on_conflict_do_update(
+            index_elements=[PhotoCacheEntry.candidate_id, PhotoCacheEntry.top_count],
+            set_={'attachments': statement.excluded.attachments, 'cached_at': statement.excluded.cached_at},
+        )
+        with self.session_scope() as session:
+            session.execute(statement, values)
+
+    @timed(DB_SECONDS, DB_ERRORS, operation='get_photos')
+    def get_photos(self, candidate_ids, top_count, max_age, negative_max_age=None):
+        """
+        Извлекает сохраненные вложения топ-фото анкет.
+        :param candidate_ids:    Список ID анкет.
+        :param top_count:        Количество фото.
+        :param max_age:          Максимальный возраст записи в секундах.
+        :param negative_max_age: Максимальный возраст записи без фото в секундах, по умолчанию - max_age.
+        :return:                 Словарь {ID анкеты: список вложений}.
         """
-        user = self.session.query(User).get(user_id)
-        if user:
-            return user.searched_users
-        else:
-            return []
+        now = datetime.utcnow()
+        negative_max_age = max_age if negative_max_age is None else negative_max_age
+        query = select(PhotoCacheEntry.candidate_id, PhotoCacheEntry.attachments).where(
+            PhotoCacheEntry.candidate_id.in_(candidate_ids),
+            PhotoCacheEntry.top_count == top_count,
+            PhotoCacheEntry.cached_at >= now - timedelta(seconds=max_age),
+            or_(PhotoCacheEntry.attachments != '',
+                PhotoCacheEntry.cached_at >= now - timedelta(seconds=negative_max_age)),
+        )
+        with self.session_scope() as session:
+            rows = session.execute(query).all()
+        return {candidate_id: attachments.split(',') if attachments else [] for candidate_id, attachments in rows}
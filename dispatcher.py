@@ -0,0 +1,158 @@
+"""
+Асинхронный диспетчер событий бота
+"""
+
+import asyncio
+import logging
+import threading
+
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from vk_api.longpoll import VkEventType
+
+# Входящее сообщение без лишних полей события: его можно передать в другой процесс
+IncomingMessage = namedtuple("IncomingMessage", ["user_id", "text"])
+
+
+def is_incoming_message(event):
+    """
+    Проверка, что событие - входящее текстовое сообщение от пользователя
+    :param event: Событие Long Poll
+    :return:      True, если событие нужно обработать
+    """
+    return (
+        event.type == VkEventType.MESSAGE_NEW
+        and event.to_me
+        and event.from_user
+        and event.text
+    )
+
+
+class EventDispatcher:
+    """
+    Диспетчер событий: сообщения одного пользователя обрабатываются
+    строго по порядку, сообщения разных пользователей - параллельно
+    """
+
+    def __init__(self, bot, concurrency=10):
+        """
+        :param bot:         Объект VKinderBot
+        :param concurrency: Максимальное количество одновременно обрабатываемых пользователей
+        """
+        self.bot = bot
+        self.concurrency = concurrency
+        self.logger = logging.getLogger(__name__)
+
+        # Очереди и обработчики по пользователям
+        self.queues = {}
+        self.workers = {}
+
+        # Блокирующие вызовы VK и базы данных выполняются в пуле потоков
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="vkinder")
+        self.semaphore = None
+
+        # Позиции Long Poll необработанных событий (атрибут checkpoint события)
+        self.in_flight = Counter()
+        self.in_flight_lock = threading.Lock()
+
+    async def run(self, events):
+        """
+        Чтение событий и распределение по очередям пользователей
+
+        :param events: Итерируемый источник событий (например, longpoll.listen())
+        """
+        loop = asyncio.get_running_loop()
+        self.start()
+        iterator = iter(events)
+
+        try:
+            while True:
+                # Чтение Long Poll блокирующее, поэтому выполняется вне цикла событий
+                event = await loop.run_in_executor(None, next, iterator, None)
+                if event is None:
+                    break
+                if is_incoming_message(event):
+                    self.dispatch(event)
+        finally:
+            await self.join()
+
+    def start(self):
+        """
+        Подготовка к приему событий. Вызывается внутри цикла событий.
+        """
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    def dispatch(self, event):
+        """
+        Постановка события в очередь пользователя
+
+        :param event: Событие
+        """
+        checkpoint = getattr(event, "checkpoint", None)
+        if checkpoint is not None:
+            with self.in_flight_lock:
+                self.in_flight[checkpoint] += 1
+        queue = self.queues.get(event.user_id)
+        if queue is None:
+            queue = asyncio.Queue()
+            self.queues[event.user_id] = queue
+            self.workers[event.user_id] = asyncio.create_task(self.worker(event.user_id, queue))
+        queue.put_nowait(event)
+
+    async def worker(self, user_id, queue):
+        """
+        Последовательная обработка очереди одного пользователя.
+        Завершается, когда очередь пуста.
+
+        :param user_id: Id пользователя
+        :param queue:   Очередь событий пользователя
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while not queue.empty():
+                event = queue.get_nowait()
+                async with self.semaphore:
+                    try:
+                        await loop.run_in_executor(self.executor, self.bot.process_message, event)
+                    except Exception:
+                        self.logger.exception(f"Ошибка при обработке сообщения пользователя {user_id}")
+                self.complete(event)
+        finally:
+            del self.queues[user_id]
+            del self.workers[user_id]
+
+    def complete(self, event):
+        """
+        Отметка события как обработанного
+        :param event: Событие
+        """
+        checkpoint = getattr(event, "checkpoint", None)
+        if checkpoint is None:
+            return
+        with self.in_flight_lock:
+            self.in_flight[checkpoint] -= 1
+            if not self.in_flight[checkpoint]:
+                del self.in_flight[checkpoint]
+
+    def position(self, committed):
+        """
+        Позиция Long Poll, с которой можно продолжить чтение без потери событий
+        :param committed: Позиция, до которой все события переданы диспетчеру
+        :return:          Позиция самой ранней пачки с необработанными событиями, либо committed
+        """
+        with self.in_flight_lock:
+            return min(self.in_flight, default=committed)
+
+    async def join(self):
+        """
+        Ожидание обработки всех поставленных в очередь событий
+        """
+        while self.workers:
+            await asyncio.gather(*self.workers.values())
+
+    def close(self):
+        """
+        Остановка пула потоков
+        """
+        self.executor.shutdown(wait=True)
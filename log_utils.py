@@ -0,0 +1,192 @@
+"""
+Логгирование: записи в формате JSON пишутся фоновым потоком через очередь
+"""
+
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import queue
+import sys
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import registry
+from ratelimit import TokenBucket
+
+# Поля контекста сообщения, попадающие в каждую запись
+CONTEXT_FIELDS = ("user_id", "step", "latency")
+# Максимальное количество записей в очереди; лишние отбрасываются
+QUEUE_SIZE = 10000
+
+log_fields = contextvars.ContextVar("log_fields", default={})
+listener = None
+
+LOG_DROPPED = registry.counter("vkinder_log_dropped_total", "Записи лога, отброшенные при переполнении очереди")
+LOG_SUPPRESSED = registry.counter("vkinder_log_suppressed_total", "Повторяющиеся записи лога, отброшенные фильтром")
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Поля, добавляемые ко всем записям лога внутри блока (в текущем потоке)
+    :param fields: Значения полей, например user_id и step
+    """
+    token = log_fields.set({**log_fields.get(), **fields})
+    try:
+        yield
+    finally:
+        log_fields.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Добавление полей контекста к записи. Выполняется в потоке,
+    создавшем запись, до передачи ее в очередь.
+    """
+
+    def filter(self, record):
+        for name, value in log_fields.get().items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Ограничение частоты предупреждений и ошибок из одного места кода.
+    Следующая пропущенная запись сообщает, сколько было отброшено.
+    """
+
+    def __init__(self, rate=1.0, burst=10, level=logging.WARNING):
+        """
+        :param rate:  Записей в секунду из одного места кода
+        :param burst: Максимальное количество записей подряд
+        :param level: Ограничиваются записи этого уровня и выше
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.level = level
+        self.buckets = {}
+        self.suppressed = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self.level or self.rate <= 0:
+            return True
+        site = (record.pathname, record.lineno)
+        with self.lock:
+            bucket = self.buckets.get(site)
+            if bucket is None:
+                bucket = self.buckets[site] = TokenBucket(self.rate, self.burst)
+            if not bucket.try_acquire():
+                self.suppressed[site] = self.suppressed.get(site, 0) + 1
+                LOG_SUPPRESSED.inc()
+                return False
+            suppressed = self.suppressed.pop(site, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Запись лога одной строкой JSON
+    """
+
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for name in CONTEXT_FIELDS + ("suppressed",):
+            value = getattr(record, name, None)
+            if value is not None:
+                data[name] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Передача записей в очередь без ожидания: при переполнении запись отбрасывается
+    """
+
+    def prepare(self, record):
+        """
+        Подготовка записи к передаче в другой поток: текст сообщения
+        и трассировка исключения вычисляются сразу, поля контекста сохраняются
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+def setup_logging(logging_file, level=logging.INFO, rate=1.0, burst=10):
+    """
+    Логгирование в файл и консоль через очередь и фоновый поток.
+    Повторный вызов в том же процессе ничего не делает.
+
+    :param logging_file: Файл лога
+    :param level:        Уровень логгирования
+    :param rate:         Частота предупреждений и ошибок из одного места кода (записей в секунду, 0 - без ограничения)
+    :param burst:        Максимальное количество таких записей подряд
+    :return:             Объект QueueListener
+    """
+    global listener
+    if listener is not None:
+        return listener
+
+    formatter = JsonFormatter()
+    file_handler = logging.FileHandler(logging_file)
+    stream_handler = logging.StreamHandler(sys.stderr)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    records = queue.Queue(maxsize=QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(records)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(RateLimitFilter(rate, burst))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    listener = QueueListener(records, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    # Записи, оставшиеся в очереди, дописываются при завершении процесса
+    atexit.register(stop_logging)
+    return listener
+
+
+def stop_logging():
+    """
+    Запись оставшихся в очереди записей и остановка фонового потока
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
@@ -2,27 +2,55 @@
 Главный файл запуска
 """
 
+import asyncio
 import logging
+import signal
 
-from vk_api.longpoll import VkLongPoll, VkEventType
+import vk_api
+
+from vk_api.longpoll import VkLongPoll
 from vk_api.exceptions import ApiError
-from vkinder import VKinderBot
-from config import GROUP_TOKEN, CONNSTR, LOGGING_FILE
+from vkinder import VKinder, VKinderBot, VK_USER_TOKENS
+from checkpoint import Checkpoint, CheckpointedLongPoll
+from db_utils import Saver
+from crawler import CandidateCrawler
+from dispatcher import EventDispatcher
+from sharding import ShardedRunner
+from metrics import start_metrics_server
+from log_utils import setup_logging
+from config import (GROUP_TOKEN, CONNSTR, LOGGING_FILE, CONCURRENCY, METRICS_PORT, MODE, WORKERS,
+                    INDEX_ENABLED, CRAWLER_CITIES, CRAWLER_STATUSES, CRAWLER_REFRESH, CHECKPOINT_DIR,
+                    CHECKPOINT_INTERVAL, SNAPSHOT_MAX_AGE, LOG_RATE, LOG_BURST)
 
 # переменные для работы
 VK_BOT_TOKEN = GROUP_TOKEN
 CONNECTION = CONNSTR
 
 
-def setup_logging():
+def create_bot():
+    """
+    Создание бота. В многопроцессном режиме вызывается в каждом процессе-обработчике.
+    """
+    setup_logging(LOGGING_FILE, rate=LOG_RATE, burst=LOG_BURST)
+    return VKinderBot(token=VK_BOT_TOKEN, connstr=CONNECTION)
+
+
+def start_crawler(vkinder, saver):
     """
-    Логгирование
+    Запуск фонового обходчика, заполняющего локальный индекс анкет
     """
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        handlers=[logging.FileHandler(LOGGING_FILE), logging.StreamHandler()],
-    )
+    crawler = CandidateCrawler(vkinder, saver, cities=CRAWLER_CITIES, statuses=CRAWLER_STATUSES,
+                               refresh=CRAWLER_REFRESH)
+    crawler.start()
+    logging.info("Обходчик анкет запущен")
+    return crawler
+
+
+def stop_on_sigterm(*args):
+    """
+    Остановка по SIGTERM так же, как по Ctrl+C: с записью контрольной точки
+    """
+    raise KeyboardInterrupt
 
 
 def main():
@@ -30,30 +58,82 @@ def main():
     Основная функция
     """
     # Инициализация логгирования
-    setup_logging()
+    setup_logging(LOGGING_FILE, rate=LOG_RATE, burst=LOG_BURST)
+    signal.signal(signal.SIGTERM, stop_on_sigterm)
 
-    # Инициализация бота
-    vkinder_bot = VKinderBot(token=VK_BOT_TOKEN, connstr=CONNECTION)
+    # Инициализация бота. В многопроцессном режиме боты создаются в обработчиках,
+    # а этому процессу нужна только сессия для чтения Long Poll
+    checkpoint = None
+    if MODE == "sharded":
+        vkinder_bot = None
+        session = vk_api.VkApi(token=VK_BOT_TOKEN)
+    else:
+        vkinder_bot = create_bot()
+        session = vkinder_bot.session
+        if CHECKPOINT_DIR:
+            # Сессии, активные перед перезапуском, восстанавливаются без обращения к базе данных
+            checkpoint = Checkpoint(CHECKPOINT_DIR, interval=CHECKPOINT_INTERVAL)
+            restored = vkinder_bot.user_data_cache.restore(checkpoint.load_sessions(SNAPSHOT_MAX_AGE))
+            logging.info(f"Восстановлено сессий из снимка: {restored}")
 
     try:
         # Запуск Long Poll
-        longpoll = VkLongPoll(vkinder_bot.session)
+        longpoll = VkLongPoll(session) if checkpoint is None else CheckpointedLongPoll(session)
     except ApiError as error:
         logging.error(f"Ошибка при запуске Long Poll: {error}")
         return
 
+    if checkpoint is not None:
+        # Продолжаем чтение с позиции, на которой остановились
+        ts = checkpoint.load_cursor()
+        if ts is not None:
+            longpoll.ts = longpoll.committed_ts = ts
+            logging.info(f"Long Poll продолжает чтение с позиции {ts}")
+
+    # Метрики для Prometheus
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+        logging.info(f"Метрики доступны на порту {METRICS_PORT}")
+
+    # Локальный индекс анкет
+    crawler = None
+    if INDEX_ENABLED:
+        if vkinder_bot is None:
+            crawler = start_crawler(VKinder(VK_USER_TOKENS), Saver(connstr=CONNECTION))
+        else:
+            crawler = start_crawler(vkinder_bot.vkinder, vkinder_bot.user_data)
+
     # Вывод сообщения о запуске
     logging.info("Бот запущен!")
 
     # Обработка сообщений
-    for event in longpoll.listen():
-        if (
-            event.type == VkEventType.MESSAGE_NEW
-            and event.to_me
-            and event.from_user
-            and event.text
-        ):
-            vkinder_bot.process_message(event)
+    if vkinder_bot is None:
+        runner = ShardedRunner(create_bot, workers=WORKERS)
+        try:
+            runner.run(longpoll.listen())
+        except KeyboardInterrupt:
+            logging.info("Бот остановлен")
+        finally:
+            if crawler is not None:
+                crawler.stop()
+        return
+
+    dispatcher = EventDispatcher(vkinder_bot, concurrency=CONCURRENCY)
+    if checkpoint is not None:
+        checkpoint.start(lambda: dispatcher.position(longpoll.committed_ts))
+    try:
+        asyncio.run(dispatcher.run(longpoll.listen()))
+    except KeyboardInterrupt:
+        logging.info("Бот остановлен")
+    finally:
+        if crawler is not None:
+            crawler.stop()
+        dispatcher.close()
+        if checkpoint is not None:
+            # Позиция - до самого раннего необработанного события, сессии - после обработки
+            checkpoint.stop()
+            checkpoint.save_sessions(vkinder_bot.user_data_cache.snapshot())
+        vkinder_bot.close()
 
 
 if __name__ == "__main__":
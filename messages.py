@@ -15,6 +15,8 @@ process_city = "Введите ID города (например, 1 для Мо
 process_status = "Введите семейное положение (1 - не женат/не замужем, 2 - встречается," \
                  " 3 - помолвлен/помолвлена, 4 - женат/замужем, 5 - всё сложно):"
 
+profile_link = 'https://vk.com/id{}'
+
 favorites = 'Вот твои избранные пользователи:\n'
 no_favorites = 'У тебя еще нет избранных =('
 
@@ -30,6 +32,8 @@ final_again = 'Больше анкет нет. Хочешь еще? Напиши
 # --------------
 session_error = "К сожалению, не удалось получить сессию ВКонтакте. Пожалуйста, предоставьте токен доступа."
 
+search_unavailable = 'ВКонтакте сейчас не отвечает. Попробуй еще раз через минуту, написав "еще".'
+
 incorrect_data = "Введены некорректные данные. Пожалуйста, повторите ввод."
 
 some_error = "Произошла ошибка. Пожалуйста, начните сначала."
@@ -0,0 +1,270 @@
+"""
+Метрики бота в текстовом формате Prometheus
+"""
+
+import cProfile
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы корзин гистограмм по умолчанию, в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=None):
+    """
+    Форматирование меток метрики
+    :param names:  Названия меток
+    :param values: Значения меток
+    :param extra:  Дополнительная пара (название, значение)
+    :return:       Строка вида {name="value"}
+    """
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """
+    Счетчик
+    """
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """
+        Увеличение счетчика
+        :param amount: Величина увеличения
+        :param labels: Значения меток
+        """
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+
+class Histogram:
+    """
+    Гистограмма
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """
+        Учет значения
+        :param value:  Значение
+        :param labels: Значения меток
+        """
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                # Счетчики корзин, сумма и количество значений
+                series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels, key, ('le', bound))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, ('le', '+Inf'))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Gauge:
+    """
+    Показатель, значение которого вычисляется при каждом запросе метрик
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def samples(self):
+        return [f"{self.name} {self.function()}"]
+
+
+class CounterFunc(Gauge):
+    """
+    Счетчик, значение которого берется из функции при каждом запросе метрик.
+    Функция должна возвращать только растущее значение.
+    """
+
+    type = "counter"
+
+
+class Registry:
+    """
+    Реестр метрик
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        """
+        Регистрация метрики. Метрика с тем же именем заменяется.
+        :param metric: Метрика
+        :return:       Метрика
+        """
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name, documentation, function):
+        return self.register(Gauge(name, documentation, function))
+
+    def counter_func(self, name, documentation, function):
+        return self.register(CounterFunc(name, documentation, function))
+
+    def render(self):
+        """
+        Все метрики в текстовом формате Prometheus
+        :return: Текст
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+# Общий реестр и метрики бота
+registry = Registry()
+
+HANDLER_SECONDS = registry.histogram("vkinder_handler_seconds", "Время обработки шага диалога", ("step",))
+HANDLER_ERRORS = registry.counter("vkinder_handler_errors_total", "Ошибки при обработке шага диалога", ("step",))
+VK_CALL_SECONDS = registry.histogram("vkinder_vk_call_seconds", "Время вызова метода API VK", ("method",))
+VK_CALL_ERRORS = registry.counter("vkinder_vk_call_errors_total", "Ошибки вызова метода API VK", ("method",))
+FLOOD_CONTROL = registry.counter("vkinder_flood_control_total", "Ответы VK о превышении частоты запросов", ("method",))
+DB_SECONDS = registry.histogram("vkinder_db_seconds", "Время операции с базой данных", ("operation",))
+DB_ERRORS = registry.counter("vkinder_db_errors_total", "Ошибки операций с базой данных", ("operation",))
+DB_POOL_WAIT_SECONDS = registry.histogram("vkinder_db_pool_wait_seconds", "Время ожидания соединения из пула БД",
+                                          buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+
+profile_lock = threading.Lock()
+
+
+@contextmanager
+def timed(histogram, errors=None, **labels):
+    """
+    Замер времени выполнения блока кода или функции
+
+    :param histogram: Гистограмма для времени выполнения
+    :param errors:    Счетчик ошибок
+    :param labels:    Значения меток
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if errors is not None:
+            errors.inc(**labels)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+@contextmanager
+def sampled_profile(rate, description=""):
+    """
+    Профилирование случайной доли вызовов. Результат пишется в лог.
+
+    :param rate:        Доля профилируемых вызовов, от 0 до 1
+    :param description: Описание профилируемого вызова
+    """
+    # Одновременно профилируется только один вызов
+    if rate <= 0 or random.random() >= rate or not profile_lock.acquire(blocking=False):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profile_lock.release()
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(15)
+        logging.getLogger(__name__).info(f"Профиль {description}:\n{stream.getvalue()}")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Обработчик запросов к /metrics
+    """
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # Запросы сборщика метрик не засоряют лог
+        pass
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """
+    Запуск HTTP-сервера метрик в фоновом потоке
+
+    :param port: Порт
+    :param host: Адрес
+    :return:     Объект сервера
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
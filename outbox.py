@@ -0,0 +1,253 @@
+"""
+Очередь исходящих сообщений бота
+"""
+
+import logging
+import threading
+import time
+
+from collections import deque
+
+from vk_api.exceptions import ApiError
+from vk_api.utils import get_random_id
+
+from metrics import timed, VK_CALL_SECONDS, VK_CALL_ERRORS, FLOOD_CONTROL
+from ratelimit import TokenBucket, FLOOD_CONTROL_CODES
+from resilience import CircuitOpenError, is_retryable
+
+# Максимальная длина текста сообщения VK
+MAX_MESSAGE_LENGTH = 4096
+# Код ошибки Flood control: ограничение относится к одному получателю
+PEER_FLOOD_CODE = 9
+
+
+class Outbox:
+    """
+    Очередь исходящих сообщений: отправка в фоновом потоке с ограничением
+    частоты, объединением подряд идущих текстов одному пользователю
+    и повторами при Flood control. Сообщение, не отправленное из-за Flood control,
+    возвращается в очередь и откладывается вместе с остальными сообщениями
+    этому пользователю, сообщения другим пользователям отправляются без задержки.
+    """
+
+    def __init__(self, api, rate=20, retries=3, backoff=1.0, resilience=None):
+        """
+        :param api:        Объект API группы
+        :param rate:       Максимальное количество отправок в секунду
+        :param retries:    Количество повторов при Flood control, временной ошибке и разомкнутой цепи
+        :param backoff:    Начальная пауза перед повтором в секундах
+        :param resilience: Объект Resilience для сроков выполнения и размыкателя цепи
+        """
+        self.api = api
+        self.resilience = resilience
+        self.bucket = TokenBucket(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.logger = logging.getLogger(__name__)
+
+        self.items = deque()
+        # Время, раньше которого нельзя писать пользователю: {id пользователя: время (monotonic)}
+        self.not_before = {}
+        # Время, до которого приостановлена вся очередь
+        self.paused_until = 0.0
+        # Время, после которого неотправленные при остановке сообщения отбрасываются
+        self.drain_deadline = None
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Запуск фонового потока отправки
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="outbox", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10.0):
+        """
+        Остановка с отправкой сообщений, оставшихся в очереди. Сообщения,
+        которые не удалось отправить за timeout секунд, отбрасываются.
+        :param timeout: Максимальное время отправки оставшихся сообщений в секундах
+        """
+        with self.condition:
+            self.running = False
+            self.drain_deadline = time.monotonic() + timeout
+            self.condition.notify()
+        if self.thread is not None:
+            # Отправка, начатая до истечения времени, может занять еще один срок вызова messages.send
+            self.thread.join(timeout + 1)
+            if self.thread.is_alive():
+                self.logger.warning("Поток отправки сообщений не завершился вовремя")
+
+    def put(self, user_id, message=None, attachment=None):
+        """
+        Постановка сообщения в очередь
+
+        :param user_id:    Id пользователя
+        :param message:    Текст сообщения
+        :param attachment: Вложения
+        """
+        item = {"user_id": user_id, "message": message, "attachment": attachment, "random_id": get_random_id(),
+                "attempt": 0}
+        with self.condition:
+            self.items.append(item)
+            self.condition.notify()
+
+    def run(self):
+        """
+        Цикл отправки сообщений
+        """
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    if not self.running and (not self.items or now >= self.drain_deadline):
+                        self.drop()
+                        return
+                    index = self.next_ready(now)
+                    if index is not None:
+                        break
+                    self.condition.wait(self.wait_time(now))
+                item = self.merge(index)
+            self.send(item)
+
+    def next_ready(self, now):
+        """
+        Позиция первого сообщения, которое можно отправить сейчас.
+        Вызывается под блокировкой очереди.
+
+        :param now: Текущее время (monotonic)
+        :return:    Индекс в очереди или None
+        """
+        if now < self.paused_until:
+            return None
+        for index, item in enumerate(self.items):
+            not_before = self.not_before.get(item["user_id"])
+            if not_before is None:
+                return index
+            if not_before <= now:
+                del self.not_before[item["user_id"]]
+                return index
+        return None
+
+    def wait_time(self, now):
+        """
+        Время до момента, когда может стать возможной следующая отправка.
+        Вызывается под блокировкой очереди.
+
+        :param now: Текущее время (monotonic)
+        :return:    Время в секундах или None, если очередь пуста
+        """
+        if not self.items:
+            return None
+        waits = [self.not_before[item["user_id"]] for item in self.items if item["user_id"] in self.not_before]
+        if now < self.paused_until:
+            waits.append(self.paused_until)
+        if not self.running:
+            waits.append(self.drain_deadline)
+        return max(min(waits, default=now) - now, 0.001)
+
+    def drop(self):
+        """
+        Отбрасывание сообщений, не отправленных до остановки.
+        Вызывается под блокировкой очереди.
+        """
+        if self.items:
+            self.logger.warning(f"При остановке не отправлено сообщений: {len(self.items)}")
+            self.items.clear()
+
+    def defer(self, item, delay):
+        """
+        Возврат сообщения в очередь: сообщения этому пользователю
+        не отправляются delay секунд. Порядок сообщений пользователю сохраняется.
+
+        :param item:  Сообщение
+        :param delay: Задержка в секундах
+        """
+        item["attempt"] += 1
+        with self.condition:
+            self.not_before[item["user_id"]] = time.monotonic() + delay
+            self.items.appendleft(item)
+            self.condition.notify()
+
+    def merge(self, index):
+        """
+        Извлечение сообщения из очереди и объединение с идущими следом
+        текстовыми сообщениями тому же пользователю.
+        Вызывается под блокировкой очереди.
+
+        :param index: Позиция первого сообщения
+        :return:      Объединенное сообщение
+        """
+        item = self.items[index]
+        del self.items[index]
+        if item["attachment"]:
+            return item
+        parts = [item["message"]]
+        length = len(item["message"])
+        while index < len(self.items):
+            following = self.items[index]
+            if following["user_id"] != item["user_id"] or following["attachment"]:
+                break
+            if following["message"] != parts[-1]:
+                if length + len(following["message"]) + 1 > MAX_MESSAGE_LENGTH:
+                    break
+                parts.append(following["message"])
+                length += len(following["message"]) + 1
+            del self.items[index]
+        item["message"] = "\n".join(parts)
+        return item
+
+    def send(self, item):
+        """
+        Отправка сообщения. Поток отправки никогда не ждет повтора:
+        при Flood control и временной ошибке сообщение возвращается в очередь
+        и откладывается для своего получателя, а при разомкнутой цепи
+        приостанавливается вся очередь до пробного вызова.
+        Повтор безопасен: VK не отправляет второй раз сообщение с тем же random_id.
+
+        :param item: Сообщение
+        """
+        params = {key: value for key, value in item.items() if value is not None and key != "attempt"}
+        self.bucket.acquire()
+        try:
+            with timed(VK_CALL_SECONDS, VK_CALL_ERRORS, method="messages.send"):
+                if self.resilience is None:
+                    self.api.messages.send(**params)
+                else:
+                    self.resilience.call_with_retries("messages.send", 0, self.api.messages.send, **params)
+            return
+        except CircuitOpenError as error:
+            if item["attempt"] < self.retries:
+                # VK недоступен: очередь ждет один раз, а не каждое сообщение по отдельности
+                self.pause(max(error.retry_after, self.backoff))
+                self.defer(item, 0)
+                return
+            self.logger.error(f"Не удалось отправить сообщение пользователю {item['user_id']}: {error}")
+        except ApiError as error:
+            if error.code in FLOOD_CONTROL_CODES:
+                FLOOD_CONTROL.inc(method="messages.send")
+            if item["attempt"] < self.retries and (error.code in FLOOD_CONTROL_CODES or is_retryable(error)):
+                delay = self.backoff * 2 ** item["attempt"]
+                if error.code in FLOOD_CONTROL_CODES and error.code != PEER_FLOOD_CODE:
+                    # Слишком много запросов в секунду: приостанавливается вся очередь
+                    self.pause(delay)
+                    delay = 0
+                self.defer(item, delay)
+                return
+            self.logger.error(f"Не удалось отправить сообщение пользователю {item['user_id']}: {error}")
+        except Exception as error:
+            if item["attempt"] < self.retries and is_retryable(error):
+                self.defer(item, self.backoff * 2 ** item["attempt"])
+                return
+            self.logger.error(f"Ошибка при отправке сообщения пользователю {item['user_id']}: {error}")
+
+    def pause(self, delay):
+        """
+        Приостановка отправки всех сообщений
+
+        :param delay: Задержка в секундах
+        """
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
@@ -0,0 +1,92 @@
+"""
+Ранжирование найденных анкет перед показом
+"""
+
+import time
+
+import numpy as np
+
+# Поля users.search, нужные для ранжирования
+SEARCH_FIELDS = "photo_id,has_photo,online,last_seen,interests,relation"
+
+# Признаки анкеты и их веса по умолчанию
+DEFAULT_WEIGHTS = {
+    "has_photo": 2.0,   # есть фото профиля
+    "online": 1.0,      # сейчас в сети
+    "recency": 3.0,     # давность последнего визита: 1 - только что, 0 - давно
+    "interests": 1.0,   # заполненность интересов: от 0 до 1
+    "relation": 0.5,    # указано семейное положение
+}
+
+# Характерное время затухания признака recency в секундах
+RECENCY_SCALE = 7 * 86400
+# Количество интересов, при котором признак interests максимален
+INTERESTS_CAP = 5
+
+
+class CandidateRanker:
+    """
+    Оценка анкет взвешенной суммой признаков. Признаки всей страницы
+    собираются в одну матрицу, оценки считаются одним матричным умножением.
+    """
+
+    def __init__(self, weights=None):
+        """
+        :param weights: Веса признаков, не указанные берутся из DEFAULT_WEIGHTS
+        """
+        weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        unknown = set(weights) - set(DEFAULT_WEIGHTS)
+        if unknown:
+            raise ValueError(f"Неизвестные признаки ранжирования: {', '.join(sorted(unknown))}")
+        self.features = tuple(DEFAULT_WEIGHTS)
+        self.weights = np.array([weights[feature] for feature in self.features], dtype=np.float64)
+
+    def feature_matrix(self, users, now=None):
+        """
+        Матрица признаков анкет
+        :param users: Анкеты в формате users.search
+        :param now:   Текущее время (unix), по умолчанию - time.time()
+        :return:      Массив размера (количество анкет, количество признаков)
+        """
+        now = time.time() if now is None else now
+        count = len(users)
+        has_photo = np.fromiter((user.get("has_photo", 1 if user.get("photo_id") else 0) for user in users),
+                                dtype=np.float64, count=count)
+        online = np.fromiter((user.get("online", 0) for user in users), dtype=np.float64, count=count)
+        last_seen = np.fromiter(((user.get("last_seen") or {}).get("time", 0) for user in users),
+                                dtype=np.float64, count=count)
+        interests = np.fromiter((len(user["interests"].split(",")) if user.get("interests") else 0
+                                 for user in users), dtype=np.float64, count=count)
+        relation = np.fromiter((user.get("relation", 0) for user in users), dtype=np.float64, count=count)
+
+        # Анкеты без даты визита считаются давно не заходившими
+        recency = np.where(last_seen > 0, np.exp(-np.maximum(now - last_seen, 0) / RECENCY_SCALE), 0.0)
+        return np.column_stack((
+            has_photo > 0,
+            online > 0,
+            recency,
+            np.minimum(interests, INTERESTS_CAP) / INTERESTS_CAP,
+            relation > 0,
+        )).astype(np.float64)
+
+    def scores(self, users, now=None):
+        """
+        Оценки анкет
+        :param users: Анкеты в формате users.search
+        :param now:   Текущее время (unix)
+        :return:      Массив оценок
+        """
+        if not users:
+            return np.zeros(0)
+        return self.feature_matrix(users, now) @ self.weights
+
+    def rank(self, users, now=None):
+        """
+        Сортировка анкет по убыванию оценки. При равной оценке
+        сохраняется порядок выдачи users.search.
+        :param users: Анкеты в формате users.search
+        :param now:   Текущее время (unix)
+        :return:      Новый список анкет
+        """
+        order = np.argsort(-self.scores(users, now), kind="stable")
+        return [users[index] for index in order]
@@ -0,0 +1,69 @@
+"""
+Ограничение частоты запросов к API
+"""
+
+import threading
+import time
+
+# Коды ошибок VK о превышении частоты запросов:
+# 6 - слишком много запросов в секунду, 9 - Flood control
+FLOOD_CONTROL_CODES = (6, 9)
+
+
+class TokenBucket:
+    """
+    Потокобезопасный ограничитель частоты по алгоритму "ведро с токенами"
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate:     Количество токенов, восполняемых в секунду
+        :param capacity: Максимальное количество накопленных токенов (по умолчанию - rate, но не меньше одного)
+        """
+        self.rate = rate
+        self.capacity = max(rate, 1) if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """
+        Восполнение токенов за прошедшее время. Вызывается под блокировкой.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        """
+        Количество доступных токенов
+        :return: Число токенов
+        """
+        with self.lock:
+            self.refill()
+            return self.tokens
+
+    def try_acquire(self):
+        """
+        Получение токена без ожидания
+        :return: True, если токен получен
+        """
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self):
+        """
+        Получение токена с ожиданием его появления
+        """
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
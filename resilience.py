@@ -0,0 +1,252 @@
+"""
+Устойчивость вызовов API VK: сроки выполнения, повторы и размыкатель цепи
+"""
+
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from vk_api.exceptions import ApiError, ApiHttpError, VkApiError
+
+from metrics import registry
+
+# Коды ошибок VK, при которых запрос имеет смысл повторить:
+# 1 - неизвестная ошибка, 10 - внутренняя ошибка сервера
+RETRYABLE_CODES = (1, 10)
+# Сроки выполнения методов по умолчанию в секундах (вместе с повторами)
+DEFAULT_DEADLINES = {"users.search": 5.0, "execute": 10.0, "messages.send": 5.0}
+
+VK_RETRIES = registry.counter("vkinder_vk_retries_total", "Повторы вызовов API VK", ("method",))
+CIRCUIT_OPENED = registry.counter("vkinder_circuit_opened_total", "Размыкания цепи вызовов API VK", ("method",))
+CIRCUIT_REJECTED = registry.counter("vkinder_circuit_rejected_total",
+                                    "Вызовы API VK, отклоненные разомкнутой цепью", ("method",))
+
+deadline = threading.local()
+
+
+class CircuitOpenError(Exception):
+    """
+    Вызов отклонен: метод недоступен, цепь разомкнута
+    """
+
+    def __init__(self, message, retry_after=0.0):
+        """
+        :param message:     Текст ошибки
+        :param retry_after: Время до пробного вызова в секундах
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(requests.Timeout):
+    """
+    Истек срок выполнения вызова
+    """
+
+
+# Ошибки, означающие, что вызов API не удался
+API_ERRORS = (VkApiError, CircuitOpenError, requests.RequestException)
+
+
+def is_retryable(error):
+    """
+    Проверка, что ошибка временная и вызов можно повторить
+    :param error: Исключение
+    :return:      True для сетевых ошибок, ошибок HTTP и временных ошибок VK
+    """
+    if isinstance(error, ApiError):
+        return error.code in RETRYABLE_CODES
+    return isinstance(error, (requests.RequestException, ApiHttpError))
+
+
+class TimeoutSession(requests.Session):
+    """
+    HTTP-сессия, ограничивающая каждый запрос оставшимся сроком вызова.
+    Передается в vk_api.VkApi(session=...).
+    """
+
+    def __init__(self, default_timeout=30.0):
+        """
+        :param default_timeout: Таймаут запроса вне вызова со сроком, в секундах
+        """
+        super().__init__()
+        self.default_timeout = default_timeout
+
+    def request(self, *args, **kwargs):
+        expires = getattr(deadline, "expires", None)
+        timeout = self.default_timeout
+        if expires is not None:
+            timeout = expires - time.monotonic()
+            if timeout <= 0:
+                raise DeadlineExceeded("Истек срок выполнения вызова")
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = timeout
+        return super().request(*args, **kwargs)
+
+
+class CircuitBreaker:
+    """
+    Размыкатель цепи: после failure_threshold временных ошибок подряд
+    вызовы отклоняются в течение reset_timeout секунд, затем пропускается
+    один пробный вызов. Успешный пробный вызов замыкает цепь.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        """
+        :param failure_threshold: Количество ошибок подряд до размыкания
+        :param reset_timeout:     Время до пробного вызова в секундах
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Проверка, можно ли выполнить вызов
+        :return: True, если цепь замкнута или пора сделать пробный вызов
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        """
+        Учет временной ошибки
+        :return: True, если цепь только что разомкнулась
+        """
+        with self.lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+                opened = self.opened_at is None
+                self.opened_at = time.monotonic()
+                self.probing = False
+                return opened
+            return False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def retry_after(self):
+        """
+        Время до пробного вызова
+        :return: Время в секундах, 0 - если цепь замкнута или пробный вызов уже возможен
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(self.opened_at + self.reset_timeout - time.monotonic(), 0.0)
+
+
+class Resilience:
+    """
+    Вызовы методов API со сроком выполнения, повторами с растущей
+    случайной паузой при временных ошибках и размыкателем цепи на каждый метод
+    """
+
+    def __init__(self, deadlines=None, default_deadline=10.0, retries=2, backoff=0.2,
+                 failure_threshold=5, reset_timeout=30.0):
+        """
+        :param deadlines:         Сроки выполнения по методам в секундах, дополняют DEFAULT_DEADLINES
+        :param default_deadline:  Срок выполнения остальных методов в секундах
+        :param retries:           Количество повторов при временной ошибке
+        :param backoff:           Начальная пауза перед повтором в секундах
+        :param failure_threshold: Количество ошибок подряд до размыкания цепи
+        :param reset_timeout:     Время до пробного вызова разомкнутой цепи в секундах
+        """
+        self.deadlines = dict(DEFAULT_DEADLINES, **(deadlines or {}))
+        self.default_deadline = default_deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def breaker(self, method):
+        """
+        Размыкатель цепи метода
+        :param method: Название метода
+        :return:       Объект CircuitBreaker
+        """
+        with self.lock:
+            breaker = self.breakers.get(method)
+            if breaker is None:
+                breaker = self.breakers[method] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return breaker
+
+    def call(self, method, function, *args, **kwargs):
+        """
+        Вызов функции, обращающейся к методу API
+
+        :param method:   Название метода
+        :param function: Функция
+        :param args:     Позиционные аргументы функции
+        :param kwargs:   Именованные аргументы функции
+        :return:         Результат функции
+        """
+        return self.call_with_retries(method, self.retries, function, *args, **kwargs)
+
+    def call_with_retries(self, method, retries, function, *args, **kwargs):
+        """
+        Вызов функции с заданным количеством повторов. Вызывающий код,
+        который сам откладывает повтор (например, очередь сообщений), передает 0.
+
+        :param method:   Название метода
+        :param retries:  Количество повторов при временной ошибке
+        :param function: Функция
+        :param args:     Позиционные аргументы функции
+        :param kwargs:   Именованные аргументы функции
+        :return:         Результат функции
+        """
+        breaker = self.breaker(method)
+        if not breaker.allow():
+            CIRCUIT_REJECTED.inc(method=method)
+            raise CircuitOpenError(f"Метод {method} временно недоступен", breaker.retry_after())
+
+        expires = time.monotonic() + self.deadlines.get(method, self.default_deadline)
+        outer = getattr(deadline, "expires", None)
+        deadline.expires = expires if outer is None else min(outer, expires)
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    result = function(*args, **kwargs)
+                except CircuitOpenError:
+                    # Вызов не дошел до VK (например, все токены пула выведены из работы): цепь не меняется
+                    raise
+                except Exception as error:
+                    if not is_retryable(error):
+                        # Ошибка запроса, а не доступности метода
+                        breaker.record_success()
+                        raise
+                    if breaker.record_failure():
+                        CIRCUIT_OPENED.inc(method=method)
+                        self.logger.warning(f"Цепь вызовов {method} разомкнута на {self.reset_timeout} с: {error}")
+                    # Пауза с полным случайным разбросом, чтобы повторы разных потоков не совпадали
+                    delay = random.uniform(0, self.backoff * 2 ** attempt)
+                    if attempt == retries or breaker.is_open or time.monotonic() + delay >= deadline.expires:
+                        raise
+                    VK_RETRIES.inc(method=method)
+                    time.sleep(delay)
+                    continue
+                breaker.record_success()
+                return result
+        finally:
+            deadline.expires = outer
@@ -0,0 +1,99 @@
+"""
+Планировщик поиска: обход результатов users.search сверх лимита в 1000 анкет
+"""
+
+import calendar
+
+from collections import namedtuple
+
+# Максимальное количество результатов users.search по одному запросу
+SEARCH_LIMIT = 1000
+
+# Страница результатов и курсор, с которого продолжается обход (None - результаты закончились)
+Page = namedtuple("Page", ["users", "cursor"])
+
+
+def days_in_month(month):
+    """
+    Количество дней в месяце с учетом 29 февраля
+    :param month: Номер месяца
+    :return:      Количество дней
+    """
+    return calendar.monthrange(2000, month)[1]
+
+
+class SearchPlanner:
+    """
+    Разбиение поиска по критериям на непересекающиеся части.
+
+    Если по критериям найдено больше анкет, чем отдает users.search,
+    после первой страницы обход сразу переходит к частям по месяцу рождения,
+    а слишком большие месяцы - к частям по дню рождения. Постранично
+    просматриваются только части, умещающиеся в лимит (или дни,
+    которые разбить уже нельзя). Курсор обхода - словарь
+    {"filters": фильтры части, "offset": смещение}, его можно сохранить
+    в базе данных и продолжить обход с того же места.
+    """
+
+    def __init__(self, search, limit=SEARCH_LIMIT):
+        """
+        :param search: Функция search(criteria, filters, count, offset), возвращающая
+                       (анкеты, общее количество) или None при ошибке.
+                       Общее количество None означает, что оно неизвестно.
+        :param limit:  Максимальное количество результатов по одному запросу
+        """
+        self.search = search
+        self.limit = limit
+
+    def pages(self, criteria, cursor=None, count=50):
+        """
+        Ленивый обход страниц результатов, начиная с курсора.
+        Анкеты разных частей могут повторяться, их отсеивает вызывающий код.
+
+        :param criteria: Критерии поиска (возраст, пол, город, положение)
+        :param cursor:   Курсор обхода, None - с начала
+        :param count:    Размер страницы
+        :return:         Генератор объектов Page; при ошибке поиска выдается None и обход завершается
+        """
+        cursor = cursor or {"filters": {}, "offset": 0}
+        filters, offset = dict(cursor["filters"]), cursor["offset"]
+        while filters is not None:
+            result = self.search(criteria, filters, count, offset)
+            if result is None:
+                yield None
+                return
+            users, total = result
+            offset += count
+            too_large = total is not None and total > self.limit and "birth_day" not in filters
+            if not users or too_large or (total is not None and offset >= min(total, self.limit)):
+                # Часть просмотрена или слишком велика: переходим к следующей или к ее частям
+                filters, offset = self.next_partition(filters, total), 0
+            yield Page(users, None if filters is None else {"filters": filters, "offset": offset})
+
+    def next_partition(self, filters, total):
+        """
+        Часть, следующая за просмотренной или слишком большой
+        :param filters: Фильтры части
+        :param total:   Количество анкет в части
+        :return:        Фильтры следующей части или None, если частей больше нет
+        """
+        if (total is None or total > self.limit) and "birth_day" not in filters:
+            # Часть больше лимита: спускаемся на уровень месяцев или дней
+            if "birth_month" not in filters:
+                return {"birth_month": 1}
+            return {"birth_month": filters["birth_month"], "birth_day": 1}
+        return self.next_sibling(filters)
+
+    @staticmethod
+    def next_sibling(filters):
+        """
+        Следующая часть того же уровня
+        :param filters: Фильтры части
+        :return:        Фильтры следующей части или None
+        """
+        month, day = filters.get("birth_month"), filters.get("birth_day")
+        if day is not None and day < days_in_month(month):
+            return {"birth_month": month, "birth_day": day + 1}
+        if month is not None and month < 12:
+            return {"birth_month": month + 1}
+        return None
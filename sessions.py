@@ -0,0 +1,332 @@
+"""
+Хранилище сессий пользователей бота
+"""
+
+import logging
+import sys
+import threading
+import time
+
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+import messages
+
+from cache import SeenIndex
+
+# Шаги, на которых пользователь вводит критерии поиска
+CRITERIA = ("age", "gender", "city", "status")
+
+
+def deep_size(value):
+    """
+    Приблизительный объем памяти значения вместе с вложенными словарями и списками
+    :param value: Значение из JSON-подобных данных (анкета, список вложений и т.п.)
+    :return:      Размер в байтах
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key) + deep_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_size(item) for item in value)
+    return size
+
+
+class UserSession:
+    """
+    Состояние диалога с пользователем
+    """
+
+    __slots__ = ("user_id", "step", "age", "gender", "city", "status", "cursor", "last",
+                 "last_id", "favorites", "in_db", "profiles", "photos", "prefetch", "photo_prefetch", "exhausted",
+                 "touched", "size")
+
+    def __init__(self, user_id, in_db=None):
+        """
+        :param user_id: Id пользователя
+        :param in_db:   Индекс просмотренных анкет
+        """
+        self.user_id = user_id
+        self.step = None
+        self.age = None
+        self.gender = None
+        self.city = None
+        self.status = None
+        self.cursor = None
+        self.last = None
+        self.last_id = None
+        self.favorites = []
+        self.in_db = SeenIndex() if in_db is None else in_db
+        self.profiles = []
+        self.photos = {}
+        self.prefetch = None
+        self.photo_prefetch = None
+        self.exhausted = False
+        self.touched = time.monotonic()
+        self.size = 0
+
+    def to_state(self, full=False):
+        """
+        Компактное представление сессии для сохранения в базе данных.
+        Из буфера анкет сохраняются только id, фото будут загружены заново.
+        :param full: Сохранить буфер анкет и фото целиком (для снимка при перезапуске)
+        :return:     Словарь с состоянием
+        """
+        if full:
+            return dict(self.to_state(), profiles=list(self.profiles), photos=self.photos)
+        return {
+            "step": self.step,
+            "age": self.age,
+            "gender": self.gender,
+            "city": self.city,
+            "status": self.status,
+            "cursor": self.cursor,
+            "last": self.last,
+            "last_id": self.last_id,
+            "favorites": self.favorites,
+            "profiles": [{"id": profile["id"]} for profile in self.profiles],
+            "exhausted": self.exhausted,
+        }
+
+    @classmethod
+    def from_state(cls, user_id, state, in_db=None):
+        """
+        Восстановление сессии из сохраненного состояния
+        :param user_id: Id пользователя
+        :param state:   Словарь с состоянием
+        :param in_db:   Индекс просмотренных анкет
+        :return:        Объект сессии
+        """
+        session = cls(user_id, in_db)
+        for key, value in state.items():
+            if key in cls.__slots__:
+                setattr(session, key, value)
+        # После JSON ключи словаря фото - строки
+        session.photos = {int(owner_id): photos for owner_id, photos in session.photos.items()}
+        return session
+
+    def memory_usage(self):
+        """
+        Приблизительный объем памяти, занимаемый сессией
+        :return: Размер в байтах
+        """
+        return (sys.getsizeof(self) + self.in_db.memory_usage() + deep_size(self.profiles)
+                + deep_size(self.favorites) + deep_size(self.photos))
+
+
+class SessionStore:
+    """
+    Ограниченное по размеру хранилище сессий. Давно не используемые
+    сессии выгружаются в базу данных и прозрачно загружаются обратно
+    при следующем сообщении пользователя. Сессии, закрепленные на время
+    обработки сообщения, не выгружаются.
+    """
+
+    def __init__(self, saver, max_sessions=10000, max_idle=3600, max_memory=None):
+        """
+        :param saver:        Объект Saver для выгрузки сессий
+        :param max_sessions: Максимальное количество сессий в памяти
+        :param max_idle:     Время бездействия в секундах, после которого сессия выгружается
+        :param max_memory:   Максимальный объем памяти сессий в байтах
+        """
+        self.saver = saver
+        self.max_sessions = max_sessions
+        self.max_idle = max_idle
+        self.max_memory = max_memory
+        self.logger = logging.getLogger(__name__)
+
+        self.sessions = OrderedDict()
+        self.pins = Counter()
+        self.spilling = {}
+        self.memory = 0
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        """
+        Получение сессии пользователя из памяти или из базы данных
+        :param user_id: Id пользователя
+        :return:        Сессия, либо None, если пользователь новый
+        """
+        with self.lock:
+            session = self.sessions.get(user_id)
+            if session is not None:
+                self.touch(session)
+            # Сессия, которая выгружается прямо сейчас, берется из памяти: в базе ее еще может не быть
+            spilling = self.spilling.get(user_id)
+        if session is not None:
+            self.evict()
+            return session
+        if spilling is not None:
+            self.add(spilling)
+            return spilling
+
+        state = self.saver.load_session_state(user_id)
+        if state is None:
+            return None
+        session = UserSession.from_state(user_id, state, self.load_seen(user_id))
+        self.add(session)
+        return session
+
+    def create(self, user_id):
+        """
+        Создание новой сессии пользователя
+        :param user_id: Id пользователя
+        :return:        Сессия
+        """
+        session = UserSession(user_id, self.load_seen(user_id))
+        session.favorites = [messages.profile_link.format(candidate_id)
+                             for candidate_id in self.saver.get_favorites(user_id)]
+        self.add(session)
+        return session
+
+    def load_seen(self, user_id):
+        """
+        Загрузка просмотренных анкет пользователя из базы данных
+        :param user_id: Id пользователя
+        :return:        Индекс просмотренных анкет
+        """
+        return SeenIndex(self.saver.get_user_data_from_db(user_id))
+
+    def add(self, session):
+        """
+        Добавление сессии в хранилище
+        :param session: Сессия
+        """
+        with self.lock:
+            self.sessions[session.user_id] = session
+            self.touch(session)
+            self.resize(session)
+        self.evict()
+
+    def touch(self, session):
+        """
+        Отметка использования сессии. Вызывается под блокировкой.
+        :param session: Сессия
+        """
+        self.sessions.move_to_end(session.user_id)
+        session.touched = time.monotonic()
+
+    def resize(self, session):
+        """
+        Пересчет объема памяти сессии. Вызывается под блокировкой.
+        :param session: Сессия
+        """
+        size = session.memory_usage()
+        self.memory += size - session.size
+        session.size = size
+
+    @contextmanager
+    def pinned(self, user_id):
+        """
+        Закрепление сессии пользователя на время обработки сообщения:
+        закрепленная сессия не выгружается. После обработки
+        пересчитывается объем памяти сессии, лишние сессии выгружаются.
+        :param user_id: Id пользователя
+        """
+        with self.lock:
+            self.pins[user_id] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.pins[user_id] -= 1
+                if not self.pins[user_id]:
+                    del self.pins[user_id]
+                session = self.sessions.get(user_id)
+                if session is not None:
+                    self.resize(session)
+            self.evict()
+
+    def evict(self):
+        """
+        Выгрузка лишних и давно не используемых сессий в базу данных
+        """
+        evicted = []
+        deadline = time.monotonic() - self.max_idle
+        with self.lock:
+            count, memory = len(self.sessions), self.memory
+            for user_id, session in self.sessions.items():
+                if (count <= self.max_sessions
+                        and (self.max_memory is None or memory <= self.max_memory)
+                        and session.touched >= deadline):
+                    break
+                if user_id in self.pins:
+                    continue
+                count -= 1
+                memory -= session.size
+                evicted.append(session)
+            for session in evicted:
+                del self.sessions[session.user_id]
+                session.size = 0
+                self.spilling[session.user_id] = session
+            self.memory = memory
+
+        for session in evicted:
+            self.spill(session)
+            with self.lock:
+                if self.spilling.get(session.user_id) is session:
+                    del self.spilling[session.user_id]
+
+    def spill(self, session):
+        """
+        Сохранение сессии в базу данных
+        :param session: Сессия
+        """
+        try:
+            self.saver.save_session_state(session.user_id, session.to_state())
+        except Exception as error:
+            self.logger.error(f"Ошибка при выгрузке сессии пользователя {session.user_id}: {error}")
+
+    def flush(self):
+        """
+        Сохранение всех сессий в базу данных (при завершении работы)
+        """
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            self.spill(session)
+
+    def snapshot(self):
+        """
+        Снимок всех сессий в памяти вместе с буферами анкет и просмотренными анкетами
+        :return: Список словарей {"user_id", "state", "seen"}
+        """
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return [{"user_id": session.user_id, "state": session.to_state(full=True), "seen": list(session.in_db)}
+                for session in sessions]
+
+    def restore(self, snapshot):
+        """
+        Восстановление сессий из снимка без обращения к базе данных
+        :param snapshot: Результат snapshot()
+        :return:         Количество восстановленных сессий
+        """
+        for item in snapshot:
+            self.add(UserSession.from_state(item["user_id"], item["state"], SeenIndex(item["seen"])))
+        return len(snapshot)
+
+    def memory_usage(self):
+        """
+        Приблизительный объем памяти всех сессий
+        :return: Размер в байтах
+        """
+        return self.memory
+
+    def peek(self, user_id):
+        """
+        Сессия из памяти без загрузки из базы данных и без отметки использования
+        :param user_id: Id пользователя
+        :return:        Сессия, либо None, если ее нет в памяти
+        """
+        with self.lock:
+            return self.sessions.get(user_id)
+
+    def __getitem__(self, user_id):
+        return self.sessions[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,169 @@
+"""
+Многопроцессный режим: один процесс читает события Long Poll
+и распределяет их по процессам-обработчикам по id пользователя
+"""
+
+import logging
+import multiprocessing
+import threading
+
+from dispatcher import IncomingMessage, is_incoming_message
+
+
+def worker_main(events, done, bot_factory):
+    """
+    Процесс-обработчик: свой VKinderBot со своим подключением к базе данных
+
+    :param events:      Очередь событий обработчика
+    :param done:        Общий счетчик: номер последнего обработанного события
+    :param bot_factory: Функция создания бота
+    """
+    bot = bot_factory()
+    logger = logging.getLogger(__name__)
+    try:
+        while True:
+            item = events.get()
+            if item is None:
+                break
+            sequence, message = item
+            try:
+                bot.process_message(message)
+            except Exception:
+                logger.exception(f"Ошибка при обработке сообщения пользователя {message.user_id}")
+            # Запись в общую память не теряется при аварийном завершении процесса
+            done.value = sequence
+    finally:
+        bot.close()
+
+
+class ShardedRunner:
+    """
+    Распределение событий по процессам-обработчикам. Сообщения одного
+    пользователя всегда попадают в один процесс и обрабатываются по порядку.
+    Упавший обработчик перезапускается, неподтвержденные события
+    передаются ему повторно.
+    """
+
+    def __init__(self, bot_factory, workers=4, supervise_interval=1.0):
+        """
+        :param bot_factory:        Функция создания бота (должна передаваться в другой процесс)
+        :param workers:            Количество процессов-обработчиков
+        :param supervise_interval: Период проверки обработчиков в секундах
+        """
+        self.bot_factory = bot_factory
+        self.workers = workers
+        self.supervise_interval = supervise_interval
+        self.logger = logging.getLogger(__name__)
+
+        self.context = multiprocessing.get_context("spawn")
+        self.done = [self.context.Value("q", 0, lock=False) for _ in range(workers)]
+        self.queues = [None] * workers
+        self.processes = [None] * workers
+        # Отправленные, но еще не обработанные события по обработчикам
+        self.pending = [{} for _ in range(workers)]
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.supervisor = None
+
+    def start(self):
+        """
+        Запуск обработчиков и потока наблюдения за ними
+        """
+        with self.lock:
+            for shard in range(self.workers):
+                self.start_worker(shard)
+        self.supervisor = threading.Thread(target=self.supervise, name="supervisor", daemon=True)
+        self.supervisor.start()
+
+    def start_worker(self, shard):
+        """
+        Запуск обработчика с новой очередью, в которую заново ставятся
+        все неподтвержденные события. Вызывается под блокировкой.
+
+        :param shard: Номер обработчика
+        """
+        self.collect_done(shard)
+        events = self.context.Queue()
+        for item in self.pending[shard].items():
+            events.put(item)
+        process = self.context.Process(target=worker_main, name=f"vkinder-worker-{shard}",
+                                       args=(events, self.done[shard], self.bot_factory), daemon=True)
+        process.start()
+        self.queues[shard] = events
+        self.processes[shard] = process
+
+    def route(self, message):
+        """
+        Передача сообщения обработчику по id пользователя
+
+        :param message: IncomingMessage
+        """
+        shard = message.user_id % self.workers
+        with self.lock:
+            self.sequence += 1
+            self.pending[shard][self.sequence] = message
+            self.queues[shard].put((self.sequence, message))
+
+    def collect_done(self, shard):
+        """
+        Удаление обработанных событий из списка ожидающих. События обработчика
+        обрабатываются по порядку, поэтому достаточно номера последнего из них.
+        Вызывается под блокировкой.
+
+        :param shard: Номер обработчика
+        """
+        done = self.done[shard].value
+        pending = self.pending[shard]
+        while pending:
+            sequence = next(iter(pending))
+            if sequence > done:
+                break
+            del pending[sequence]
+
+    def supervise(self):
+        """
+        Наблюдение за обработчиками: очистка обработанных событий и перезапуск упавших
+        """
+        while not self.stopped.wait(self.supervise_interval):
+            with self.lock:
+                for shard, process in enumerate(self.processes):
+                    self.collect_done(shard)
+                    if not process.is_alive():
+                        self.logger.error(f"Обработчик {shard} завершился с кодом {process.exitcode}, перезапуск. "
+                                          f"Ожидают обработки: {len(self.pending[shard])}")
+                        self.start_worker(shard)
+
+    def run(self, events):
+        """
+        Чтение событий и распределение по обработчикам
+
+        :param events: Итерируемый источник событий
+        """
+        self.start()
+        try:
+            for event in events:
+                if is_incoming_message(event):
+                    self.route(IncomingMessage(event.user_id, event.text))
+        finally:
+            self.stop()
+
+    def stop(self, timeout=30):
+        """
+        Остановка: обработчики завершают работу после обработки своих очередей
+
+        :param timeout: Время ожидания каждого обработчика в секундах
+        """
+        self.stopped.set()
+        if self.supervisor is not None:
+            self.supervisor.join()
+        with self.lock:
+            for events in self.queues:
+                events.put(None)
+        for process in self.processes:
+            process.join(timeout)
+        for shard in range(self.workers):
+            self.collect_done(shard)
+        lost = sum(len(pending) for pending in self.pending)
+        if lost:
+            self.logger.warning(f"Не обработано событий при остановке: {lost}")
@@ -0,0 +1,12 @@
+"""
+Общие настройки тестов: модули бота импортируются из корня репозитория
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+# config.py читает settings.ini из текущего каталога
+os.chdir(ROOT)
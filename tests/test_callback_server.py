@@ -0,0 +1,105 @@
+"""
+Сервер Callback API
+"""
+
+import asyncio
+import json
+
+from http import HTTPStatus
+
+from callback_server import CallbackServer
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.messages = []
+
+    def start(self):
+        pass
+
+    def dispatch(self, message):
+        self.messages.append(message)
+
+
+def message_event(event_id, user_id=1, text="привет", secret="secret"):
+    return {
+        "type": "message_new",
+        "event_id": event_id,
+        "group_id": 5,
+        "secret": secret,
+        "object": {"message": {"from_id": user_id, "peer_id": user_id, "text": text}},
+    }
+
+
+def make_server(**kwargs):
+    dispatcher = FakeDispatcher()
+    server = CallbackServer(dispatcher, "abc123", secret="secret", host="127.0.0.1", port=0, group_id=5, **kwargs)
+    return server, dispatcher
+
+
+def test_confirmation_without_secret():
+    server, _ = make_server()
+
+    assert server.handle_event({"type": "confirmation", "group_id": 5}) == (HTTPStatus.OK, "abc123")
+
+
+def test_confirmation_from_other_group_is_rejected():
+    server, _ = make_server()
+
+    assert server.handle_event({"type": "confirmation", "group_id": 6})[0] == HTTPStatus.FORBIDDEN
+
+
+def test_wrong_secret_is_rejected():
+    server, dispatcher = make_server()
+
+    assert server.handle_event(message_event("1", secret="wrong"))[0] == HTTPStatus.FORBIDDEN
+    assert dispatcher.messages == []
+
+
+def test_repeated_event_is_dispatched_once():
+    server, dispatcher = make_server()
+
+    assert server.handle_event(message_event("1")) == (HTTPStatus.OK, "ok")
+    assert server.handle_event(message_event("1")) == (HTTPStatus.OK, "ok")
+    assert server.handle_event(message_event("2", text="еще")) == (HTTPStatus.OK, "ok")
+
+    assert [(message.user_id, message.text) for message in dispatcher.messages] == [(1, "привет"), (1, "еще")]
+
+
+def request(server, raw):
+    """
+    Отправка сырого HTTP-запроса запущенному серверу
+    :return: Кортеж (строка статуса, тело ответа)
+    """
+    async def main():
+        await server.start()
+        port = server.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(raw)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        server.server.close()
+        await server.server.wait_closed()
+        return response
+    head, _, body = asyncio.run(main()).partition(b"\r\n\r\n")
+    return head.split(b"\r\n")[0].decode(), body.decode()
+
+
+def test_http_confirmation():
+    server, _ = make_server()
+    body = json.dumps({"type": "confirmation", "group_id": 5}).encode()
+
+    status, text = request(server, b"POST / HTTP/1.1\r\nConnection: close\r\nContent-Length: %d\r\n\r\n%s"
+                           % (len(body), body))
+
+    assert status == "HTTP/1.1 200 OK"
+    assert text == "abc123"
+
+
+def test_unreadable_request_gets_bad_request():
+    server, _ = make_server()
+
+    status, _ = request(server, b"POST / HTTP/1.1\r\nContent-Length: abc\r\n\r\n")
+
+    assert status == "HTTP/1.1 400 Bad Request"
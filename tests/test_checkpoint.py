@@ -0,0 +1,77 @@
+"""
+Контрольные точки для быстрого перезапуска
+"""
+
+import os
+
+from checkpoint import Checkpoint
+from sessions import SessionStore, UserSession
+
+
+class FakeSaver:
+    """
+    Saver, к которому сессии из снимка обращаться не должны
+    """
+
+    def save_session_state(self, user_id, state):
+        raise AssertionError("сессия выгружена в базу данных")
+
+    def load_session_state(self, user_id):
+        raise AssertionError("сессия загружена из базы данных")
+
+
+def make_session(user_id):
+    session = UserSession(user_id)
+    session.step = "final"
+    session.age, session.gender, session.city, session.status = "25", "1", "1", 6
+    session.cursor = {"filters": {"birth_month": 3}, "offset": 50}
+    session.profiles = [{"id": 100 + user_id, "first_name": "Анна"}]
+    session.photos = {100 + user_id: ["photo1_1", "photo1_2"]}
+    session.favorites = ["https://vk.com/id7"]
+    session.in_db.add(7)
+    return session
+
+
+def test_sessions_round_trip(tmp_path):
+    store = SessionStore(FakeSaver())
+    for user_id in (1, 2):
+        store.add(make_session(user_id))
+    checkpoint = Checkpoint(str(tmp_path))
+
+    checkpoint.save_sessions(store.snapshot())
+    restored = SessionStore(FakeSaver())
+    assert restored.restore(checkpoint.load_sessions(max_age=600)) == 2
+
+    session = restored.get(2)
+    assert session.step == "final"
+    assert session.cursor == {"filters": {"birth_month": 3}, "offset": 50}
+    assert session.profiles == [{"id": 102, "first_name": "Анна"}]
+    assert session.photos == {102: ["photo1_1", "photo1_2"]}
+    assert session.favorites == ["https://vk.com/id7"]
+    assert 7 in session.in_db
+
+
+def test_snapshot_is_read_once(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path))
+    checkpoint.save_sessions([{"user_id": 1, "state": make_session(1).to_state(full=True), "seen": [7]}])
+
+    assert len(checkpoint.load_sessions(max_age=600)) == 1
+    assert not os.path.exists(checkpoint.snapshot_path)
+    assert checkpoint.load_sessions(max_age=600) == []
+
+
+def test_old_snapshot_is_ignored(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path))
+    checkpoint.save_sessions([{"user_id": 1, "state": make_session(1).to_state(full=True), "seen": []}])
+
+    assert checkpoint.load_sessions(max_age=-1) == []
+
+
+def test_longpoll_cursor_round_trip(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path))
+    assert checkpoint.load_cursor() is None
+
+    checkpoint.start(lambda: 1234)
+    checkpoint.stop()
+
+    assert Checkpoint(str(tmp_path)).load_cursor() == 1234
@@ -0,0 +1,81 @@
+"""
+Асинхронный диспетчер событий
+"""
+
+import asyncio
+import random
+import threading
+import time
+
+from dispatcher import EventDispatcher, IncomingMessage
+
+
+class RecordingBot:
+    """
+    Бот, который запоминает порядок обработки и количество одновременно обрабатываемых сообщений
+    """
+
+    def __init__(self):
+        self.processed = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def process_message(self, event):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(random.uniform(0, 0.005))
+        with self.lock:
+            self.active -= 1
+            self.processed.append((event.user_id, event.text))
+
+
+class CheckpointedMessage:
+    def __init__(self, user_id, text, checkpoint):
+        self.user_id = user_id
+        self.text = text
+        self.checkpoint = checkpoint
+
+
+def run_dispatcher(bot, dispatcher, events):
+    async def main():
+        dispatcher.start()
+        for event in events:
+            dispatcher.dispatch(event)
+        await dispatcher.join()
+    asyncio.run(main())
+    dispatcher.close()
+
+
+def test_messages_of_one_user_keep_order():
+    bot = RecordingBot()
+    events = [IncomingMessage(user_id, str(number)) for number in range(20) for user_id in range(1, 6)]
+
+    run_dispatcher(bot, EventDispatcher(bot, concurrency=4), events)
+
+    assert len(bot.processed) == len(events)
+    for user_id in range(1, 6):
+        assert [text for sender, text in bot.processed if sender == user_id] == [str(n) for n in range(20)]
+
+
+def test_different_users_are_processed_concurrently():
+    bot = RecordingBot()
+    events = [IncomingMessage(user_id, "0") for user_id in range(1, 21)]
+
+    run_dispatcher(bot, EventDispatcher(bot, concurrency=4), events)
+
+    assert 1 < bot.max_active <= 4
+
+
+def test_position_waits_for_unfinished_events():
+    dispatcher = EventDispatcher(RecordingBot())
+    first, second = CheckpointedMessage(1, "a", 100), CheckpointedMessage(2, "b", 105)
+    dispatcher.in_flight.update([first.checkpoint, second.checkpoint])
+
+    assert dispatcher.position(110) == 100
+    dispatcher.complete(first)
+    assert dispatcher.position(110) == 105
+    dispatcher.complete(second)
+    assert dispatcher.position(110) == 110
+    dispatcher.close()
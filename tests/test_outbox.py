@@ -0,0 +1,117 @@
+"""
+Очередь исходящих сообщений
+"""
+
+import time
+
+from vk_api.exceptions import ApiError
+
+from outbox import Outbox
+from resilience import Resilience
+from vkinder import VKinderBot
+
+
+class FakeMessages:
+    """
+    messages.send, который отвечает ошибкой VK пользователям из failing (True - всем)
+    """
+
+    def __init__(self, code=10, failing=True):
+        self.code = code
+        self.failing = failing
+        self.calls = []
+        self.sent = []
+
+    def send(self, **params):
+        self.calls.append(params["user_id"])
+        if self.failing is True or params["user_id"] in (self.failing or ()):
+            raise ApiError(None, "messages.send", params, {}, {"error_code": self.code, "error_msg": "error"})
+        self.sent.append((params["user_id"], params["message"]))
+
+
+class FakeApi:
+    def __init__(self, messages):
+        self.messages = messages
+
+
+def test_open_circuit_pauses_whole_queue_once():
+    messages = FakeMessages()
+    resilience = Resilience(failure_threshold=1, reset_timeout=0.3)
+    outbox = Outbox(FakeApi(messages), rate=1000, backoff=0.05, resilience=resilience)
+    outbox.start()
+    for user_id in range(1, 6):
+        outbox.put(user_id, f"message {user_id}")
+
+    time.sleep(0.15)
+    # Цепь разомкнулась на первом сообщении, остальные не отправлялись
+    assert messages.calls == [1]
+
+    messages.failing = False
+    outbox.stop(timeout=2)
+    assert sorted(messages.sent) == [(user_id, f"message {user_id}") for user_id in range(1, 6)]
+
+
+def test_flood_control_defers_only_one_recipient():
+    messages = FakeMessages(code=9, failing={1})
+    outbox = Outbox(FakeApi(messages), rate=1000, backoff=0.2)
+    outbox.put(1, "first")
+    outbox.put(2, "second")
+
+    outbox.start()
+    time.sleep(0.05)
+    messages.failing = False
+    # Сообщение второму пользователю не ждет повтора первому
+    assert messages.sent == [(2, "second")]
+
+    outbox.stop(timeout=2)
+    assert messages.sent == [(2, "second"), (1, "first")]
+
+
+def test_stop_drops_messages_after_timeout():
+    messages = FakeMessages()
+    resilience = Resilience(failure_threshold=1, reset_timeout=60)
+    outbox = Outbox(FakeApi(messages), rate=1000, resilience=resilience)
+    outbox.start()
+    outbox.put(1, "lost")
+
+    start = time.monotonic()
+    outbox.stop(timeout=0.2)
+
+    assert time.monotonic() - start < 1
+    assert not outbox.thread.is_alive()
+    assert not outbox.items
+
+
+class FakeResponse:
+    ok = True
+
+    @staticmethod
+    def json():
+        return {"response": 1}
+
+
+class FakeHttp:
+    """
+    HTTP-сессия vk_api, которая не обращается к VK и запоминает вызванные методы
+    """
+
+    def __init__(self):
+        self.methods = []
+
+    def post(self, url, values, **kwargs):
+        self.methods.append(url.rsplit("/", 1)[-1])
+        return FakeResponse()
+
+
+def test_bot_sends_at_outbox_rate(tmp_path):
+    bot = VKinderBot(token="group", connstr=f"sqlite:///{tmp_path / 'bot.db'}")
+    bot.session.http = FakeHttp()
+
+    start = time.monotonic()
+    for user_id in range(10):
+        bot.send_message(user_id, "привет")
+    bot.close()
+
+    # С паузой vk_api по умолчанию (0.34 с) 10 сообщений отправлялись бы больше 3 секунд
+    assert bot.session.http.methods == ["messages.send"] * 10
+    assert time.monotonic() - start < 1.5
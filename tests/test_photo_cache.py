@@ -0,0 +1,34 @@
+"""
+Сохранение топ-фото анкет в базе данных
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from db_utils import Saver, PhotoCacheEntry
+
+
+def age_entries(saver, seconds):
+    """
+    Сдвиг времени сохранения всех записей в прошлое
+    """
+    with saver.session_scope() as session:
+        session.execute(update(PhotoCacheEntry).values(cached_at=datetime.utcnow() - timedelta(seconds=seconds)))
+
+
+def test_negative_entries_expire_by_negative_ttl(tmp_path):
+    saver = Saver(f"sqlite:///{tmp_path / 'photos.db'}")
+    saver.save_photos({1: ["photo1_10", "photo1_11"], 2: []}, top_count=3)
+    age_entries(saver, 600)
+
+    stored = saver.get_photos([1, 2], top_count=3, max_age=86400, negative_max_age=300)
+
+    assert stored == {1: ["photo1_10", "photo1_11"]}
+
+
+def test_fresh_negative_entries_are_returned(tmp_path):
+    saver = Saver(f"sqlite:///{tmp_path / 'photos.db'}")
+    saver.save_photos({2: []}, top_count=3)
+
+    assert saver.get_photos([2], top_count=3, max_age=86400, negative_max_age=300) == {2: []}
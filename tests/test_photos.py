@@ -0,0 +1,85 @@
+"""
+Пакетное получение топ-фото анкет через execute
+"""
+
+import re
+
+import pytest
+
+from vk_api.exceptions import ApiError
+
+import vkinder
+from cache import TTLCache
+from vkinder import VKinder, EXECUTE_LIMIT, PHOTO_MAX_PAGES
+
+
+def photo_pages(owner_id):
+    """
+    Страницы альбома в формате PHOTOS_SCRIPT: у фото с id n - n лайков,
+    у фото владельца 3 - ни одного фото
+    """
+    ids = [] if owner_id == 3 else [1, 5, 2, 4]
+    return [{
+        "id": ids,
+        "likes": [{"count": photo_id} for photo_id in ids],
+        "comments": [{"count": 0} for _ in ids],
+        "tags": [{"count": 0} for _ in ids],
+    }]
+
+
+class StubApi:
+    """
+    Заглушка VKinder.call_api: отвечает на execute по списку owners из кода,
+    по запросу отвечает ошибкой
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.failing = False
+
+    def __call__(self, method, **params):
+        assert method == "execute"
+        owners = [int(owner) for owner in re.search(r"var owners = \[([^\]]*)\]", params["code"]).group(1).split(",")]
+        self.chunks.append(owners)
+        if self.failing:
+            raise ApiError(None, method, params, {}, {"error_code": 10, "error_msg": "Internal server error"})
+        return [{"owner_id": owner_id, "pages": photo_pages(owner_id)} for owner_id in owners]
+
+
+@pytest.fixture
+def finder(monkeypatch):
+    monkeypatch.setattr(vkinder, "photo_cache", TTLCache(maxsize=100, ttl=60, stale_ttl=3600))
+    finder = VKinder(["token"])
+    finder.photo_cache = vkinder.photo_cache
+    finder.call_api = StubApi()
+    return finder
+
+
+def test_owners_are_chunked_per_execute_limit(finder):
+    owners = list(range(100, 120))
+
+    finder.get_top_photos_many(owners)
+
+    chunk_size = max(1, EXECUTE_LIMIT // PHOTO_MAX_PAGES)
+    assert finder.call_api.chunks == [owners[start:start + chunk_size] for start in range(0, len(owners), chunk_size)]
+
+
+def test_attachments_are_mapped_to_owners(finder):
+    result = finder.get_top_photos_many([1, 2, 3], top_count=2)
+
+    assert result == {1: ["photo1_5", "photo1_4"], 2: ["photo2_5", "photo2_4"], 3: []}
+
+
+def test_cached_owners_are_not_requested_again(finder):
+    finder.get_top_photos_many([1, 2])
+    finder.get_top_photos_many([1, 2, 3])
+
+    assert finder.call_api.chunks == [[1, 2], [3]]
+
+
+def test_error_returns_stale_photos_or_none(finder):
+    # Запись устарела, но еще в окне stale_ttl
+    finder.photo_cache.set((1, 3), ["photo1_5", "photo1_4", "photo1_2"], ttl=-1)
+    finder.call_api.failing = True
+
+    assert finder.get_top_photos_many([1, 2]) == {1: ["photo1_5", "photo1_4", "photo1_2"], 2: None}
@@ -0,0 +1,120 @@
+"""
+Локальный индекс анкет и планировщик поиска
+"""
+
+from sqlalchemy import create_engine, text
+
+from db_utils import Saver
+from ranking import CandidateRanker
+from search_planner import SearchPlanner, days_in_month
+
+CRITERIA = (25, 1, 1, 6)
+
+
+def make_saver(tmp_path):
+    return Saver(f"sqlite:///{tmp_path / 'index.db'}")
+
+
+def index_search(saver, calls):
+    """
+    Функция поиска для планировщика: первая часть из индекса, остальные - "живые" запросы
+    """
+    def search(criteria, filters, count, offset):
+        calls.append(filters)
+        if not filters:
+            return saver.get_candidates(*criteria, count=count, offset=offset, max_age=3600)
+        return [], 0
+    return search
+
+
+def test_get_candidates_returns_stored_total(tmp_path):
+    saver = make_saver(tmp_path)
+    users = [{"id": candidate_id, "is_closed": False} for candidate_id in range(1, 31)]
+    saver.save_candidates(*CRITERIA, users, total=45)
+
+    page, total = saver.get_candidates(*CRITERIA, count=20, offset=0, max_age=3600)
+
+    assert [user["id"] for user in page] == list(range(1, 21))
+    assert total == 45
+
+
+def test_get_candidates_without_index(tmp_path):
+    saver = make_saver(tmp_path)
+
+    assert saver.get_candidates(*CRITERIA, count=20, offset=0, max_age=3600) is None
+
+
+def test_small_total_takes_no_partition(tmp_path):
+    saver = make_saver(tmp_path)
+    saver.save_candidates(*CRITERIA, [{"id": candidate_id} for candidate_id in range(1, 31)], total=45)
+    calls = []
+
+    pages = list(SearchPlanner(index_search(saver, calls)).pages(CRITERIA, count=20))
+
+    assert all(call == {} for call in calls)
+    assert sum(len(page.users) for page in pages) == 30
+    assert pages[-1].cursor is None
+
+
+def test_large_total_is_partitioned(tmp_path):
+    saver = make_saver(tmp_path)
+    saver.save_candidates(*CRITERIA, [{"id": candidate_id} for candidate_id in range(1, 31)], total=5000)
+    calls = []
+
+    list(SearchPlanner(index_search(saver, calls)).pages(CRITERIA, count=20))
+
+    assert {"birth_month": 1} in calls
+
+
+def test_large_partition_split_after_first_page():
+    # Весь поиск и март больше лимита, остальные месяцы и дни марта умещаются в него
+    def total_of(filters):
+        if not filters:
+            return 5000
+        if filters["birth_month"] == 3:
+            return 40 if "birth_day" in filters else 1500
+        return 300
+
+    calls = []
+
+    def search(criteria, filters, count, offset):
+        calls.append((dict(filters), offset))
+        total = total_of(filters)
+        return [{"id": offset + number} for number in range(min(count, total - offset))], total
+
+    list(SearchPlanner(search).pages(CRITERIA, count=100))
+
+    assert [offset for filters, offset in calls if not filters] == [0]
+    assert [offset for filters, offset in calls if filters == {"birth_month": 3}] == [0]
+    assert [offset for filters, offset in calls if filters == {"birth_month": 1}] == [0, 100, 200]
+    assert len([filters for filters, _ in calls if "birth_day" in filters]) == days_in_month(3)
+
+
+def test_index_keeps_ranking_fields(tmp_path):
+    saver = make_saver(tmp_path)
+    users = [{"id": 1, "photo_id": "1_10", "has_photo": 1, "online": 1, "last_seen": {"time": 1700000000},
+              "interests": "книги, музыка", "relation": 6},
+             {"id": 2}]
+    saver.save_candidates(*CRITERIA, users, total=2)
+
+    page, _ = saver.get_candidates(*CRITERIA, count=20, offset=0, max_age=3600)
+
+    assert page[0] == dict(users[0], is_closed=False)
+    assert page[1] == {"id": 2, "photo_id": None, "is_closed": False}
+    assert [user["id"] for user in CandidateRanker().rank(page, now=1700000000)] == [1, 2]
+
+
+def test_old_index_gets_ranking_columns(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'index.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE candidates (city INTEGER, sex INTEGER, age INTEGER, status INTEGER, "
+                                "candidate_id INTEGER, photo_id VARCHAR, "
+                                "PRIMARY KEY (city, sex, age, status, candidate_id))"))
+        connection.execute(text("INSERT INTO candidates VALUES (1, 1, 25, 6, 1, NULL)"))
+    engine.dispose()
+
+    saver = make_saver(tmp_path)
+
+    assert saver.get_candidates(*CRITERIA, count=20, offset=0, max_age=3600) is None
+    saver.save_candidates(*CRITERIA, [{"id": 1, "online": 1}], total=1)
+    assert saver.get_candidates(*CRITERIA, count=20, offset=0, max_age=3600)[0][0]["online"] == 1
@@ -0,0 +1,79 @@
+"""
+Многопроцессный режим: порядок сообщений пользователя и повтор после падения обработчика
+"""
+
+import functools
+import os
+import time
+
+from dispatcher import IncomingMessage
+from sharding import ShardedRunner
+
+
+class RecordingBot:
+    """
+    Бот, записывающий обработанные сообщения в файл. На первом сообщении "crash"
+    процесс завершается аварийно, при повторе оно обрабатывается как обычное.
+    """
+
+    def __init__(self, log_path, marker_path):
+        self.log_path = log_path
+        self.marker_path = marker_path
+
+    def process_message(self, message):
+        if message.text == "crash" and not os.path.exists(self.marker_path):
+            open(self.marker_path, "w").close()
+            os._exit(1)
+        with open(self.log_path, "a") as log:
+            log.write(f"{message.user_id} {message.text}\n")
+
+    def close(self):
+        pass
+
+
+def read_log(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as log:
+        return [line.split() for line in log.read().splitlines()]
+
+
+def run_sharded(tmp_path, messages):
+    log_path, marker_path = str(tmp_path / "log"), str(tmp_path / "crashed")
+    runner = ShardedRunner(functools.partial(RecordingBot, log_path, marker_path), workers=2,
+                           supervise_interval=0.1)
+    runner.start()
+    try:
+        for user_id, text in messages:
+            runner.route(IncomingMessage(user_id, text))
+        deadline = time.monotonic() + 30
+        while len(read_log(log_path)) < len(messages):
+            assert time.monotonic() < deadline, "сообщения не обработаны"
+            time.sleep(0.05)
+    finally:
+        runner.stop()
+    return read_log(log_path), os.path.exists(marker_path)
+
+
+def by_user(records):
+    result = {}
+    for user_id, text in records:
+        result.setdefault(int(user_id), []).append(text)
+    return result
+
+
+def test_messages_of_user_keep_order(tmp_path):
+    messages = [(user_id, str(number)) for number in range(20) for user_id in range(1, 6)]
+
+    records, _ = run_sharded(tmp_path, messages)
+
+    assert by_user(records) == {user_id: [str(number) for number in range(20)] for user_id in range(1, 6)}
+
+
+def test_pending_messages_replayed_after_worker_crash(tmp_path):
+    messages = [(2, "0"), (3, "0"), (2, "1"), (2, "crash"), (2, "2"), (3, "1"), (2, "3")]
+
+    records, crashed = run_sharded(tmp_path, messages)
+
+    assert crashed
+    assert by_user(records) == {2: ["0", "1", "crash", "2", "3"], 3: ["0", "1"]}
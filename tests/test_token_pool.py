@@ -0,0 +1,50 @@
+"""
+Пул токенов пользователя
+"""
+
+import pytest
+
+from vk_api.exceptions import ApiError
+
+from token_pool import TokenPool, TokensParkedError
+
+
+class StubSession:
+    """
+    Сессия VK, которая отвечает ошибкой с кодом error_code (None - успешно)
+    """
+
+    def __init__(self, error_code=None):
+        self.error_code = error_code
+        self.calls = 0
+
+    def method(self, method, params):
+        self.calls += 1
+        if self.error_code is not None:
+            raise ApiError(None, method, params, {}, {"error_code": self.error_code, "error_msg": "error"})
+        return {"count": 0, "items": []}
+
+
+def test_parked_token_is_not_called_again():
+    session = StubSession(error_code=29)
+    pool = TokenPool([session], rate=100)
+
+    with pytest.raises(TokensParkedError):
+        pool.call("users.search", {})
+    with pytest.raises(TokensParkedError) as error:
+        pool.call("users.search", {})
+
+    assert session.calls == 1
+    assert error.value.retry_after > 3000
+    assert pool.available() == 0
+
+
+def test_request_moves_to_another_token():
+    parked, healthy = StubSession(error_code=5), StubSession()
+    pool = TokenPool([parked, healthy], rate=100)
+
+    for _ in range(3):
+        assert pool.call("users.search", {}) == {"count": 0, "items": []}
+
+    assert parked.calls <= 1
+    assert healthy.calls == 3
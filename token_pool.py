@@ -0,0 +1,118 @@
+"""
+Пул токенов пользователя для запросов к API VK
+"""
+
+import logging
+import threading
+import time
+
+from vk_api.exceptions import ApiError
+
+from metrics import FLOOD_CONTROL
+from ratelimit import TokenBucket, FLOOD_CONTROL_CODES
+from resilience import CircuitOpenError
+
+# Время в секундах, на которое токен выводится из работы после ошибки:
+# 5 - ошибка авторизации, 6 - слишком много запросов в секунду,
+# 9 - Flood control, 29 - исчерпан дневной лимит метода
+PARK_TIMES = {5: 3600, 6: 1, 9: 60, 29: 3600}
+
+
+class TokensParkedError(CircuitOpenError):
+    """
+    Все токены пула временно выведены из работы
+    """
+
+
+class PooledToken:
+    """
+    Токен пула: своя сессия VK (с постоянным HTTP-соединением) и свой лимит частоты
+    """
+
+    def __init__(self, session, rate):
+        """
+        :param session: Объект vk_api.VkApi
+        :param rate:    Количество запросов в секунду
+        """
+        self.session = session
+        self.bucket = TokenBucket(rate)
+        self.parked_until = 0.0
+
+
+class TokenPool:
+    """
+    Распределение запросов между токенами по оставшемуся лимиту частоты.
+    Токены с ошибками лимитов или авторизации временно выводятся из работы.
+    """
+
+    def __init__(self, sessions, rate=3):
+        """
+        :param sessions: Сессии VK, по одной на токен
+        :param rate:     Количество запросов в секунду на токен
+        """
+        if not sessions:
+            raise ValueError("Пул токенов пуст")
+        self.tokens = [PooledToken(session, rate) for session in sessions]
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def acquire(self):
+        """
+        Выбор токена с наибольшим запасом лимита. Если лимит исчерпан
+        у всех токенов, ожидает освобождения.
+        :return: Токен пула
+        :raises TokensParkedError: Все токены выведены из работы. Пока они не освободятся,
+                                   поиск отдается из кэша.
+        """
+        while True:
+            now = time.monotonic()
+            with self.lock:
+                active = [token for token in self.tokens if token.parked_until <= now]
+                if not active:
+                    retry_after = min(token.parked_until for token in self.tokens) - now
+                    raise TokensParkedError(f"Все токены выведены из работы, ближайший освободится "
+                                            f"через {retry_after:.0f} с", retry_after)
+                token = max(active, key=lambda item: item.bucket.available())
+                if token.bucket.try_acquire():
+                    return token
+                delay = (1 - token.bucket.available()) / token.bucket.rate
+            time.sleep(max(delay, 0.001))
+
+    def park(self, token, seconds):
+        """
+        Временный вывод токена из работы
+        :param token:   Токен пула
+        :param seconds: Время в секундах
+        """
+        with self.lock:
+            token.parked_until = max(token.parked_until, time.monotonic() + seconds)
+
+    def call(self, method, params):
+        """
+        Вызов метода API через наименее загруженный токен.
+        При ошибке лимита или авторизации токен выводится из работы,
+        а запрос повторяется с другим токеном.
+
+        :param method: Название метода
+        :param params: Параметры
+        :return:       Ответ метода
+        """
+        for attempt in range(len(self.tokens) + 1):
+            token = self.acquire()
+            try:
+                return token.session.method(method, params)
+            except ApiError as error:
+                if error.code in FLOOD_CONTROL_CODES:
+                    FLOOD_CONTROL.inc(method=method)
+                if error.code not in PARK_TIMES or attempt == len(self.tokens):
+                    raise
+                self.logger.warning(f"Токен выведен из работы на {PARK_TIMES[error.code]} с: {error}")
+                self.park(token, PARK_TIMES[error.code])
+
+    def available(self):
+        """
+        Количество токенов, доступных для запросов
+        :return: Число токенов
+        """
+        now = time.monotonic()
+        return sum(1 for token in self.tokens if token.parked_until <= now)
@@ -2,19 +2,83 @@
 Функции для работы бота
 """
 # pylint: disable = import-error, invalid-name, line-too-long
+import heapq
 import logging
 import sys
+import time
 
-import vk_api
+from concurrent.futures import ThreadPoolExecutor
 
-from vk_api.exceptions import ApiError
+import vk_api
 
 import messages
+from cache import TTLCache
+from metrics import (registry, timed, sampled_profile, HANDLER_SECONDS, HANDLER_ERRORS,
+                     VK_CALL_SECONDS, VK_CALL_ERRORS)
 from db_utils import Saver
-from config import USER_TOKEN
+from log_utils import log_context
+from outbox import Outbox
+from resilience import Resilience, TimeoutSession, API_ERRORS
+from ranking import CandidateRanker, SEARCH_FIELDS
+from search_planner import SearchPlanner
+from sessions import SessionStore, CRITERIA
+from token_pool import TokenPool
+from config import (USER_TOKENS, USER_TOKEN_RATE, SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, SEND_RATE,
+                    SESSION_LIMIT, SESSION_IDLE, SESSION_MEMORY, LOW_WATER_MARK, PREFETCH_WORKERS,
+                    PROFILE_RATE, INDEX_ENABLED, INDEX_MAX_AGE, PHOTO_CACHE_SIZE, PHOTO_CACHE_TTL,
+                    PHOTO_NEGATIVE_TTL, PHOTO_CACHE_PERSISTENT, PHOTO_MAX_PAGES, WRITE_BEHIND,
+                    FLUSH_INTERVAL, FLUSH_SIZE, POOL_SIZE, MAX_OVERFLOW, POOL_TIMEOUT, RANKING_WEIGHTS,
+                    VK_DEADLINE, VK_DEADLINES, VK_RETRIES, CIRCUIT_THRESHOLD, CIRCUIT_RESET, STALE_TTL)
+
+# Токены пользователей для поиска
+VK_USER_TOKENS = USER_TOKENS
+
+# Максимальное количество обращений к API в одном вызове execute
+EXECUTE_LIMIT = 25
+# Максимальное количество фото в одном ответе photos.getAll
+PHOTO_PAGE_SIZE = 200
+
+# Постраничная загрузка фото нескольких пользователей в одном вызове execute.
+# Из каждой страницы возвращаются только поля, нужные для выбора топ-фото.
+PHOTOS_SCRIPT = """
+var owners = [{owners}];
+var result = [];
+var i = 0;
+while (i < owners.length) {{
+    var pages = [];
+    var offset = 0;
+    var count = 1;
+    while (pages.length < {max_pages} && offset < count) {{
+        var response = API.photos.getAll({{"owner_id": owners[i], "extended": 1,
+                                           "count": {page_size}, "offset": offset}});
+        if (response) {{
+            count = response.count;
+            pages.push({{"id": response.items@.id, "likes": response.items@.likes,
+                        "comments": response.items@.comments, "tags": response.items@.tags}});
+            offset = offset + {page_size};
+        }} else {{
+            count = 0;
+        }}
+    }}
+    result.push({{"owner_id": owners[i], "pages": pages}});
+    i = i + 1;
+}}
+return result;
+"""
+
+# Общий для процесса кэш результатов поиска
+search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL, stale_ttl=STALE_TTL)
+registry.counter_func("vkinder_search_cache_hits_total", "Попадания в кэш поиска", lambda: search_cache.hits)
+registry.counter_func("vkinder_search_cache_misses_total", "Промахи кэша поиска", lambda: search_cache.misses)
 
-# Токен пользователя для поиска
-VK_USER_TOKEN = USER_TOKEN
+# Общий для процесса кэш вложений топ-фото анкет
+photo_cache = TTLCache(maxsize=PHOTO_CACHE_SIZE, ttl=PHOTO_CACHE_TTL, stale_ttl=STALE_TTL)
+registry.counter_func("vkinder_photo_cache_hits_total", "Попадания в кэш фото", lambda: photo_cache.hits)
+registry.counter_func("vkinder_photo_cache_misses_total", "Промахи кэша фото", lambda: photo_cache.misses)
+
+# Общие для процесса сроки выполнения, повторы и размыкатели цепи вызовов API
+vk_resilience = Resilience(VK_DEADLINES, default_deadline=VK_DEADLINE, retries=VK_RETRIES,
+                           failure_threshold=CIRCUIT_THRESHOLD, reset_timeout=CIRCUIT_RESET)
 
 
 class VKinder:
@@ -22,9 +86,21 @@ class VKinder:
     Класс для поиска пользователей
     """
 
-    def __init__(self, token):
-        self.session = self.get_vk_session(token)
+    def __init__(self, tokens, cache=None, saver=None):
+        """
+        :param tokens: Токен пользователя или список токенов
+        :param cache:  Кэш результатов поиска, по умолчанию - общий для процесса
+        :param saver:  Объект Saver для хранения кэша фото в базе данных
+        """
+        if isinstance(tokens, str):
+            tokens = [tokens]
+        sessions = [session for session in map(self.get_vk_session, tokens) if session is not None]
+        self.pool = TokenPool(sessions, rate=USER_TOKEN_RATE)
         self.logger = logging.getLogger(__name__)
+        self.search_cache = search_cache if cache is None else cache
+        self.photo_cache = photo_cache
+        self.saver = saver
+        self.resilience = vk_resilience
 
     @staticmethod
     def get_vk_session(token):
@@ -34,7 +110,7 @@ class VKinder:
         :return: Объект сессии, None при ошибке
         """
         try:
-            session = vk_api.VkApi(token=token)
+            session = vk_api.VkApi(token=token, session=TimeoutSession())
         except vk_api.exceptions.ApiError as error:
             logging.error(f"Ошибка создании сессии ВК пользователя: {error}")
             return None
@@ -43,21 +119,55 @@ class VKinder:
             return None
         return session
 
-    def search_users(self, age, gender, city, status, count=50, offset=0):
+    def call_api(self, method, **params):
         """
-        Поиск по критериям
-        :param age:    Возраст
-        :param gender: Пол
-        :param city:   Город
-        :param status: Семейное положение
-        :param count:  Количество пользователей
-        :param offset: Смещение
-        :return:       Список пользователей
+        Вызов метода API через пул токенов с замером времени,
+        сроком выполнения, повторами и размыкателем цепи
+        :param method: Название метода
+        :param params: Параметры
+        :return:       Ответ метода
+        """
+        with timed(VK_CALL_SECONDS, VK_CALL_ERRORS, method=method):
+            return self.resilience.call(method, self.pool.call, method, params)
+
+    def search_users(self, age, gender, city, status, count=50, offset=0, use_cache=True, **filters):
         """
-        api = self.session.get_api()
+        Поиск по критериям
+        :param age:       Возраст
+        :param gender:    Пол
+        :param city:      Город
+        :param status:    Семейное положение
+        :param count:     Количество пользователей
+        :param offset:    Смещение
+        :param use_cache: Использовать общий кэш результатов
+        :param filters:   Дополнительные параметры users.search (birth_month, birth_day и т.п.)
+        :return:          Список пользователей
+        """
+        result = self.search_page(age, gender, city, status, count, offset, use_cache, **filters)
+        return None if result is None else result[0]
+
+    def search_page(self, age, gender, city, status, count=50, offset=0, use_cache=True, **filters):
+        """
+        Страница поиска по критериям вместе с общим количеством найденных
+        :param age:       Возраст
+        :param gender:    Пол
+        :param city:      Город
+        :param status:    Семейное положение
+        :param count:     Количество пользователей
+        :param offset:    Смещение
+        :param use_cache: Использовать общий кэш результатов
+        :param filters:   Дополнительные параметры users.search
+        :return:          Кортеж (список пользователей, общее количество), None при ошибке
+        """
+        # Ключ кэша - нормализованные критерии, фильтры и страница
+        key = (int(age), int(gender), int(city), int(status), tuple(sorted(filters.items())), count, offset)
+        cached = self.search_cache.get(key) if use_cache else None
+        if cached is not None:
+            return list(cached[0]), cached[1]
 
         try:
-            users = api.users.search(
+            users = self.call_api(
+                "users.search",
                 count=count,
                 age_from=age,
                 age_to=age,
@@ -65,13 +175,21 @@ class VKinder:
                 city=city,
                 status=status,
                 offset=offset,
-                fields="photo_id"
+                fields=SEARCH_FIELDS,
+                **filters
             )
-        except vk_api.exceptions.ApiError as e:
+        except API_ERRORS as e:
+            # Пока VK недоступен, отдаем последний успешный результат
+            cached = self.search_cache.get_stale(key)
+            if cached is not None:
+                logging.warning(f"Поиск пользователей из устаревшего кэша: {e}")
+                return list(cached[0]), cached[1]
             logging.error(f"Ошибка при поиске пользователей: {e}")
             return None
 
-        return users["items"]
+        if use_cache:
+            self.search_cache.set(key, (users["items"], users["count"]))
+        return list(users["items"]), users["count"]
 
     def get_photo_popularity(self, photo_id):
         """
@@ -79,44 +197,106 @@ class VKinder:
         :param photo_id: Id фото
         :return: Количество лайков и комментариев
         """
-        api = self.session.get_api()
         try:
-            photo_data = api.photos.getById(photos=photo_id)[0]
-        except vk_api.exceptions.ApiError as e:
+            photo_data = self.call_api("photos.getById", photos=photo_id)[0]
+        except API_ERRORS as e:
             logging.error(f"Ошибка при получении информации о фото: {e}")
             return 0
 
-        return photo_data["likes"]["count"] + photo_data["comments"]["count"]
+        return self.photo_popularity(photo_data["likes"], photo_data["comments"])
 
     def get_top_photos(self, user_id, top_count=3):
         """
         Получение топ n фото
         :param user_id: Id пользователя
         :param top_count: Количество фото
-        :return: Топ n фото
+        :return: Вложения топ n фото, пустой список если фото нет или альбом закрыт, None при ошибке
         """
-        api = self.session.get_api()
-        try:
-            # Получаем фото пользователя
-            photos = api.photos.getAll(owner_id=user_id, extended=1)
-            if photos['count'] == 0:
-                return None
-            # Сортируем по популярности
-            popular_photos = sorted(
-                photos["items"], key=lambda x: x["likes"]["count"], reverse=True
-            )
-            # Возвращаем топ n фото
-            top_photos = popular_photos[:top_count]
-            # Получаем фото, где пользователь отмечен
-            tagged_photos = [photo for photo in photos["items"] if photo.get("tags")]
-            # Сортируем по популярности
-            tagged_photos = sorted(tagged_photos, key=lambda x: x["likes"]["count"], reverse=True)
-            # Добавляем к топ-фото
-            top_photos += tagged_photos[:top_count - len(top_photos)]
-            return top_photos
-        except vk_api.exceptions.ApiError as e:
-            logging.error(f"Ошибка при получении фото пользователя: {e}")
-            return None
+        return self.get_top_photos_many([user_id], top_count).get(user_id)
+
+    def get_top_photos_many(self, user_ids, top_count=3):
+        """
+        Получение топ n фото сразу для нескольких пользователей.
+        Сначала используется общий кэш, остальные запросы упаковываются
+        по 25 в один вызов execute.
+        :param user_ids:  Список id пользователей
+        :param top_count: Количество фото
+        :return:          Словарь {id пользователя: вложения топ n фото или None при ошибке}
+        """
+        result = {}
+        missing = []
+        for owner_id in user_ids:
+            attachments = self.photo_cache.get((owner_id, top_count))
+            if attachments is None:
+                missing.append(owner_id)
+            else:
+                result[owner_id] = attachments
+
+        if missing and self.saver is not None:
+            stored = self.saver.get_photos(missing, top_count, max_age=PHOTO_CACHE_TTL,
+                                           negative_max_age=PHOTO_NEGATIVE_TTL)
+            for owner_id, attachments in stored.items():
+                ttl = PHOTO_CACHE_TTL if attachments else PHOTO_NEGATIVE_TTL
+                self.photo_cache.set((owner_id, top_count), attachments, ttl=ttl)
+            result.update(stored)
+            missing = [owner_id for owner_id in missing if owner_id not in stored]
+
+        fetched = {}
+        # Каждая страница альбома - отдельное обращение к API внутри execute
+        chunk_size = max(1, EXECUTE_LIMIT // PHOTO_MAX_PAGES)
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            code = PHOTOS_SCRIPT.format(owners=",".join(str(int(owner_id)) for owner_id in chunk),
+                                        max_pages=PHOTO_MAX_PAGES, page_size=PHOTO_PAGE_SIZE)
+            try:
+                responses = self.call_api("execute", code=code)
+            except API_ERRORS as e:
+                logging.error(f"Ошибка при пакетном получении фото пользователей: {e}")
+                # Пока VK недоступен, отдаем последние успешно полученные фото
+                result.update({owner_id: self.photo_cache.get_stale((owner_id, top_count)) for owner_id in chunk})
+                continue
+            for response in responses:
+                # Закрытые альбомы и анкеты без фото тоже кэшируются, но на меньший срок
+                attachments = self.rank_photos(response["owner_id"], response["pages"], top_count)
+                ttl = PHOTO_CACHE_TTL if attachments else PHOTO_NEGATIVE_TTL
+                self.photo_cache.set((response["owner_id"], top_count), attachments, ttl=ttl)
+                fetched[response["owner_id"]] = attachments
+
+        if fetched and self.saver is not None:
+            self.saver.save_photos(fetched, top_count)
+        result.update(fetched)
+        return result
+
+    @staticmethod
+    def photo_popularity(likes, comments):
+        """
+        Популярность фото
+        :param likes:    Лайки фото (объект likes из ответа API)
+        :param comments: Комментарии фото (объект comments из ответа API)
+        :return:         Количество лайков и комментариев
+        """
+        return likes["count"] + comments["count"]
+
+    @classmethod
+    def rank_photos(cls, owner_id, pages, top_count=3):
+        """
+        Выбор топ n фото за один проход по всем страницам альбома.
+        В куче хранится не больше top_count фото; при равной популярности
+        выше фото, на которых пользователь отмечен.
+        :param owner_id:  Id пользователя
+        :param pages:     Страницы в сжатом виде: {"id": [...], "likes": [...], "comments": [...], "tags": [...]}
+        :param top_count: Количество фото
+        :return:          Список строк вложений вида photo<owner_id>_<id>, от самого популярного
+        """
+        top = []
+        for page in pages:
+            for photo_id, likes, comments, tags in zip(page["id"], page["likes"], page["comments"], page["tags"]):
+                key = (cls.photo_popularity(likes, comments), bool(tags and tags.get("count")), photo_id)
+                if len(top) < top_count:
+                    heapq.heappush(top, key)
+                elif key > top[0]:
+                    heapq.heapreplace(top, key)
+        return [f"photo{owner_id}_{photo_id}" for _, _, photo_id in sorted(top, reverse=True)]
 
 
 class VKinderBot:
@@ -124,23 +304,43 @@ class VKinderBot:
     Бот для группы
     """
     def __init__(self, token, **kwargs):
+        self.logger = logging.getLogger(__name__)
         self.session = self.get_vk_session(token)
+        # Частоту отправки ограничивает очередь сообщений: встроенная пауза vk_api
+        # между вызовами (около 3 в секунду) иначе не дает выйти на SEND_RATE
+        self.session.RPS_DELAY = 0
         self.api = self.session.get_api()
         self.vkinder = None
 
-        # Количество сохраняемых пользователей за один поиск
-        self.top_users = 5
+        # Исходящие сообщения отправляются в фоне
+        self.outbox = Outbox(self.api, rate=SEND_RATE, resilience=vk_resilience)
+        self.outbox.start()
+
+        # Размер страницы поиска и минимальный запас анкет в буфере,
+        # при котором в фоне загружается следующая страница
+        self.page_size = 50
+        self.low_water_mark = LOW_WATER_MARK
+        self.prefetcher = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+        self.planner = SearchPlanner(self.search_partition)
+        self.ranker = CandidateRanker(RANKING_WEIGHTS)
 
         # Кэш локальный и базы данных
-        self.user_data_cache = {}
-        self.user_data = Saver(**kwargs)
+        self.user_data = Saver(pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT,
+                               write_behind=WRITE_BEHIND, flush_interval=FLUSH_INTERVAL, flush_size=FLUSH_SIZE,
+                               **kwargs)
+        self.user_data_cache = SessionStore(self.user_data, max_sessions=SESSION_LIMIT,
+                                            max_idle=SESSION_IDLE, max_memory=SESSION_MEMORY)
+        registry.gauge("vkinder_active_sessions", "Сессии пользователей в памяти", lambda: len(self.user_data_cache))
+        registry.gauge("vkinder_db_connections_in_use", "Соединения с БД, выданные из пула",
+                       self.user_data.connections_in_use)
 
-        token = VK_USER_TOKEN
         try:
-            self.vkinder = VKinder(token)
+            self.vkinder = VKinder(VK_USER_TOKENS, saver=self.user_data if PHOTO_CACHE_PERSISTENT else None)
         except Exception as error:
             logging.error(error)
             sys.exit(1)
+        registry.gauge("vkinder_user_tokens_available", "Токены пользователей, доступные для запросов",
+                       self.vkinder.pool.available)
 
         # Состояния при работе с пользователем
         self.step_handlers = {
@@ -158,11 +358,11 @@ class VKinderBot:
         Отправляет фотографии и ссылку на пользователя ВКонтакте.
 
         :param user_id: int, идентификатор пользователя, которому отправлять сообщение.
-        :param photos:  список фотографий.
+        :param photos:  список вложений фотографий, может быть пустым или None.
         :param link:    str, ссылка на пользователя ВКонтакте.
         """
-        attachments = ",".join([f"photo{photo['owner_id']}_{photo['id']}" for photo in photos])
-        self.api.messages.send(user_id=user_id, attachment=attachments, message=link, random_id=0)
+        attachments = ",".join(photos or [])
+        self.outbox.put(user_id, message=link, attachment=attachments or None)
 
     def send_message(self, user_id, message):
         """
@@ -171,75 +371,234 @@ class VKinderBot:
         :param user_id: Id пользователя
         :param message: Сообщение
         """
-        try:
-            self.api.messages.send(user_id=user_id, message=message, random_id=0)
-        except ApiError:
-            # Если ошибка `Flood control`, пропускаем
-            pass
+        self.outbox.put(user_id, message=message)
 
-    def process_age(self, user_id, *args):
+    def close(self):
+        """
+        Завершение работы: отправка сообщений, оставшихся в очереди,
+        сохранение сессий и запись буфера базы данных
+        """
+        self.prefetcher.shutdown(wait=False, cancel_futures=True)
+        self.outbox.stop()
+        self.user_data_cache.flush()
+        self.user_data.close()
+
+    def process_age(self, session, *args):
         """
         Ввод года
-        :param user_id: Id пользователя
+        :param session: Сессия пользователя
         :return:        Статус пользователя в боте
         """
-        self.send_message(user_id, messages.process_age)
+        self.send_message(session.user_id, messages.process_age)
         return "age"
 
-    def process_gender(self, user_id, *args):
+    def process_gender(self, session, *args):
         """
         Ввод пола
-        :param user_id: Id пользователя
+        :param session: Сессия пользователя
         :return:        Статус пользователя в боте
         """
-        self.send_message(user_id, messages.process_gender)
+        self.send_message(session.user_id, messages.process_gender)
         return "gender"
 
-    def process_city(self, user_id, *args):
+    def process_city(self, session, *args):
         """
         Ввод города
-        :param user_id: Id пользователя
+        :param session: Сессия пользователя
         :return:        Статус пользователя в боте
         """
-        self.send_message(user_id, messages.process_city)
+        self.send_message(session.user_id, messages.process_city)
         return "city"
 
-    def process_status(self, user_id, *args):
+    def process_status(self, session, *args):
         """
         Ввод семейного положения
-        :param user_id: Id пользователя
+        :param session: Сессия пользователя
         :return:        Статус пользователя в боте
         """
-        self.send_message(user_id, messages.process_status)
+        self.send_message(session.user_id, messages.process_status)
         return "status"
 
-    def get_next_profile(self, user_id):
+    def get_next_profile(self, session):
         """
-        Возвращает следующую анкету из сохраненных для данного пользователя.
+        Возвращает следующую анкету из буфера для данного пользователя.
+        Когда в буфере остается мало анкет, следующая страница поиска
+        загружается в фоне. Фото нескольких следующих анкет тоже загружаются в фоне.
 
-        :param user_id: int, идентификатор пользователя.
+        :param session: UserSession, сессия пользователя.
         :return: dict, информация об анкете или None, если анкеты закончились.
         """
-        if not self.user_data_cache[user_id].get('profiles'):
-            age, gender, city, status = (
-                self.user_data_cache[user_id]["age"],
-                self.user_data_cache[user_id]["gender"],
-                self.user_data_cache[user_id]["city"],
-                self.user_data_cache[user_id]["status"],
-            )
-
-            self.user_data_cache[user_id]["offset"] += self.top_users
+        if session.prefetch is not None and session.prefetch.done():
+            # Загрузка отсоединяется от сессии до чтения результата: ошибка не повторится при следующем запросе
+            prefetch, session.prefetch = session.prefetch, None
+            page = self.prefetch_result(session, prefetch)
+            if page is not None:
+                self.merge_page(session, page)
+        if session.photo_prefetch is not None and session.photo_prefetch.done():
+            photo_prefetch, session.photo_prefetch = session.photo_prefetch, None
             try:
-                users = self.vkinder.search_users(age, gender, city, status,
-                                                  offset=self.user_data_cache[user_id]["offset"])
-            except ApiError:
-                self.send_message(user_id, messages.session_error)
-                return None
-            self.user_data_cache[user_id]['profiles'] = [user for user in users if
-                                                         not user.get('is_closed', True) and user['id'] not in
-                                                         self.user_data_cache[user_id]['in_db']][
-                                                        :self.top_users]
-        return self.user_data_cache[user_id]['profiles'].pop(-1)
+                session.photos.update((owner_id, photos) for owner_id, photos in photo_prefetch.result().items()
+                                      if photos is not None)
+            except Exception:
+                # Фото будут загружены при показе анкеты
+                self.logger.exception(f"Ошибка при фоновой загрузке фото для пользователя {session.user_id}")
+        if not session.profiles and not self.load_profiles(session):
+            self.send_message(session.user_id, messages.search_unavailable)
+            return None
+        if not session.profiles:
+            return None
+        profile = session.profiles.pop(0)
+        if len(session.profiles) < self.low_water_mark:
+            self.start_prefetch(session)
+        self.start_photo_prefetch(session)
+        return profile
+
+    def load_profiles(self, session):
+        """
+        Загрузка страниц поиска в буфер, пока в нем не появятся
+        непросмотренные анкеты или не закончатся результаты.
+
+        :param session: UserSession, сессия пользователя.
+        :return: bool, False при ошибке поиска.
+        """
+        while not session.profiles and not session.exhausted:
+            if session.prefetch is not None:
+                prefetch, session.prefetch = session.prefetch, None
+                page = self.prefetch_result(session, prefetch)
+            else:
+                # Пользователь ждет анкету: страница загружается в текущем потоке, без очереди фоновых загрузок
+                page = self.load_page(session)
+            if page is None:
+                return False
+            self.merge_page(session, page)
+        return True
+
+    def prefetch_result(self, session, prefetch):
+        """
+        Результат фоновой загрузки страницы. Если загрузка завершилась
+        исключением, страница загружается заново в текущем потоке.
+
+        :param session:  UserSession, сессия пользователя.
+        :param prefetch: Future, фоновая загрузка.
+        :return: tuple, результат fetch_page, или None при ошибке.
+        """
+        try:
+            return prefetch.result()
+        except Exception:
+            self.logger.exception(f"Ошибка при фоновой загрузке анкет пользователя {session.user_id}")
+        return self.load_page(session)
+
+    def load_page(self, session):
+        """
+        Загрузка следующей страницы поиска в текущем потоке.
+
+        :param session: UserSession, сессия пользователя.
+        :return: tuple, результат fetch_page, или None при ошибке.
+        """
+        criteria = (session.age, session.gender, session.city, session.status)
+        try:
+            return self.fetch_page(criteria, session.cursor, session.in_db)
+        except Exception:
+            self.logger.exception(f"Ошибка при загрузке анкет пользователя {session.user_id}")
+            return None
+
+    def start_prefetch(self, session):
+        """
+        Запуск фоновой загрузки следующей страницы поиска, если она еще не запущена.
+
+        :param session: UserSession, сессия пользователя.
+        """
+        if session.prefetch is None and not session.exhausted:
+            criteria = (session.age, session.gender, session.city, session.status)
+            session.prefetch = self.prefetcher.submit(self.fetch_page, criteria, session.cursor, session.in_db)
+
+    def start_photo_prefetch(self, session):
+        """
+        Запуск фоновой загрузки фото следующих low_water_mark анкет буфера,
+        для которых фото еще не загружены. Остальные анкеты страницы
+        могут так и не быть показаны, их фото не загружаются.
+
+        :param session: UserSession, сессия пользователя.
+        """
+        if session.photo_prefetch is not None:
+            return
+        owners = [profile['id'] for profile in session.profiles[:self.low_water_mark]
+                  if profile['id'] not in session.photos]
+        if owners:
+            session.photo_prefetch = self.prefetcher.submit(self.vkinder.get_top_photos_many, owners)
+
+    def search_partition(self, criteria, filters, count, offset):
+        """
+        Страница одной части поиска для планировщика.
+        Первая часть (без фильтров) берется из локального индекса, если он есть и не устарел.
+        Общее количество из индекса - сохраненный обходчиком ответ VK, поэтому
+        планировщик не разбивает на части поиск, который помещается в один запрос.
+
+        :param criteria: tuple, критерии поиска.
+        :param filters:  dict, фильтры части.
+        :param count:    int, размер страницы.
+        :param offset:   int, смещение страницы.
+        :return: tuple (анкеты, общее количество или None, если оно неизвестно) или None при ошибке.
+        """
+        if INDEX_ENABLED and not filters:
+            result = self.user_data.get_candidates(*criteria, count=count, offset=offset, max_age=INDEX_MAX_AGE)
+            if result is not None:
+                return result
+        return self.vkinder.search_page(*criteria, count=count, offset=offset, **filters)
+
+    def fetch_page(self, criteria, cursor, in_db):
+        """
+        Загрузка страницы поиска без фото: фото загружаются для показываемой
+        анкеты и в фоне для нескольких следующих (start_photo_prefetch).
+        Анкеты страницы сортируются по оценке ранжирования.
+        Выполняется в фоновом потоке и не изменяет сессию.
+
+        :param criteria: tuple, критерии поиска.
+        :param cursor:   dict, курсор планировщика поиска.
+        :param in_db:    SeenIndex, просмотренные анкеты.
+        :return: tuple (курсор следующей страницы, анкеты) или None при ошибке.
+        """
+        page = next(self.planner.pages(criteria, cursor, self.page_size), None)
+        if page is None:
+            return None
+        profiles = self.ranker.rank([user for user in page.users
+                                     if not user.get('is_closed', True) and user['id'] not in in_db])
+        return page.cursor, profiles
+
+    def merge_page(self, session, page):
+        """
+        Добавление загруженной страницы в буфер анкет.
+        Анкеты, уже просмотренные или уже стоящие в буфере, пропускаются:
+        части поиска могут пересекаться.
+
+        :param session: UserSession, сессия пользователя.
+        :param page:    tuple, результат fetch_page.
+        """
+        cursor, profiles = page
+        session.cursor = cursor
+        session.exhausted = cursor is None
+        buffered = {profile['id'] for profile in session.profiles}
+        session.profiles.extend(profile for profile in profiles
+                                if profile['id'] not in session.in_db and profile['id'] not in buffered)
+
+    def show_profile(self, session, profile):
+        """
+        Отправка анкеты пользователю и сохранение ее как просмотренной.
+
+        :param session: UserSession, сессия пользователя.
+        :param profile: dict, анкета.
+        """
+        user_id = session.user_id
+        link = messages.profile_link.format(profile['id'])
+        session.last = link
+        session.last_id = profile['id']
+        self.user_data.save_session_to_db(user_id, [profile["id"]])
+        session.in_db.add(profile["id"])
+        if profile["id"] in session.photos:
+            top_photos = session.photos.pop(profile["id"])
+        else:
+            top_photos = self.vkinder.get_top_photos(profile["id"])
+        self.send_photos_and_link(user_id, top_photos, link)
 
     def process_message(self, event):
         """
@@ -247,73 +606,91 @@ class VKinderBot:
 
         :param event: Событие
         """
-        current_data = self.user_data_cache.get(event.user_id)
+        start = time.perf_counter()
+        # Сессия закреплена в памяти до конца обработки: ее не выгрузит другой поток
+        with log_context(user_id=event.user_id), self.user_data_cache.pinned(event.user_id), \
+                sampled_profile(PROFILE_RATE, f"сообщения пользователя {event.user_id}"):
+            session = self.handle_message(event)
+            self.logger.info("Сообщение обработано", extra={
+                "step": session.step,
+                "latency": round(time.perf_counter() - start, 6),
+            })
 
-        if current_data is None:
-            self.initialize_user_data(event.user_id)
-            current_step = None
-        else:
-            if event.text.lower() == 'избранное':
-                self.handle_favorites(event.user_id)
-                return
-            current_step = current_data['step']
+    def handle_message(self, event):
+        """
+        Определение шага пользователя и обработка сообщения.
+        Сессия берется из хранилища один раз и передается обработчикам шагов.
+
+        :param event: Событие
+        :return:      Сессия пользователя
+        """
+        session = self.user_data_cache.get(event.user_id)
+
+        if session is None:
+            session = self.initialize_user_data(event.user_id)
+        elif event.text.lower() == 'избранное':
+            self.handle_favorites(session)
+            return session
 
-        self.handle_current_step(event.user_id, event.text, current_step)
+        with log_context(step=session.step):
+            self.handle_current_step(session, event.text)
+        return session
 
     def initialize_user_data(self, user_id):
         """
         Инициализация данных пользователя при первом взаимодействии
 
         :param user_id: ID пользователя
+        :return:        Сессия пользователя
         """
-        # Инициализация в кэше
-        self.user_data_cache[user_id] = {'step': None, 'offset': 0, 'last': None, 'favorites': []}
-        # Поиск в базе данных
-        self.user_data_cache[user_id]['in_db'] = self.user_data.get_user_data_from_db(user_id)
+        # Инициализация в кэше с загрузкой просмотренных анкет из базы данных
+        session = self.user_data_cache.create(user_id)
         # Отправим приветствие
-        greet_message = messages.greet_again if self.user_data_cache[user_id]['in_db'] else messages.greet_status
+        greet_message = messages.greet_again if session.in_db else messages.greet_status
         self.send_message(user_id, greet_message)
+        return session
 
-    def handle_current_step(self, user_id, text, current_step):
+    def handle_current_step(self, session, text):
         """
         Обработка текущего шага бота
 
-        :param user_id:      ID пользователя
-        :param text:         Текст сообщения
-        :param current_step: Текущий шаг
+        :param session: Сессия пользователя
+        :param text:    Текст сообщения
         """
+        current_step = session.step
         if current_step in self.step_handlers:
             handler = self.step_handlers[current_step]
             if self.is_valid_input(text, current_step):
-                next_step = handler(user_id, text, current_step)
-                self.user_data_cache[user_id][current_step] = text
+                with timed(HANDLER_SECONDS, HANDLER_ERRORS, step=current_step):
+                    next_step = handler(session, text, current_step)
+                if current_step in CRITERIA:
+                    setattr(session, current_step, text)
             else:
-                self.send_message(user_id, messages.incorrect_data)
+                self.send_message(session.user_id, messages.incorrect_data)
                 next_step = current_step
         else:
-            self.send_message(user_id, messages.incorrect_data)
+            self.send_message(session.user_id, messages.incorrect_data)
             next_step = current_step
 
-        self.user_data_cache[user_id]['step'] = next_step
+        session.step = next_step
 
-    def handle_favorites(self, user_id):
-        users = self.user_data_cache[user_id]['favorites']
+    def handle_favorites(self, session):
+        users = session.favorites
         if users:
-            self.send_message(user_id, '\n'.join([messages.favorites,
-                                                 '\n'.join(users)]))
+            self.send_message(session.user_id, '\n'.join([messages.favorites,
+                                                         '\n'.join(users)]))
         else:
-            self.send_message(user_id, messages.no_favorites)
+            self.send_message(session.user_id, messages.no_favorites)
 
-    def handle_final_step(self, user_id, text, _):
+    def handle_final_step(self, session, text, _):
+        user_id = session.user_id
         if text.lower() == "еще":
-            next_profile = self.get_next_profile(user_id)
+            next_profile = self.get_next_profile(session)
             if next_profile:
-                link = f"https://vk.com/id{next_profile['id']}"
-                self.user_data_cache[user_id]['last'] = link
-                self.user_data.save_session_to_db(user_id, [next_profile["id"]])
-                self.user_data_cache[user_id]['in_db'].append(next_profile["id"])
-                top_photos = self.vkinder.get_top_photos(next_profile["id"])
-                self.send_photos_and_link(user_id, top_photos, link)
+                self.show_profile(session, next_profile)
+                return "final"
+            elif not session.exhausted:
+                # Поиск не удался, анкеты еще есть: пользователь может повторить запрос
                 return "final"
             else:
                 self.send_message(user_id, messages.final_again)
@@ -323,41 +700,35 @@ class VKinderBot:
                                                   messages.process_age]))
             return "age"
         elif text.lower() == "в избранное":
+            if session.last is None:
+                self.send_message(user_id, messages.some_error)
+                return "final"
+            if session.last not in session.favorites:
+                session.favorites.append(session.last)
+                if session.last_id is not None:
+                    self.user_data.add_favorite(user_id, session.last_id)
             self.send_message(user_id, 'Добавил в избранное!')
-            self.user_data_cache[user_id]['favorites'].append(self.user_data_cache[user_id]['last'])
             return "final"
         else:
             self.send_message(user_id, messages.some_error)
             return "final"
 
-    def handle_search_users(self, user_id, text, current_step):
+    def handle_search_users(self, session, text, current_step):
+        user_id = session.user_id
         if self.is_valid_input(text, "status"):
-            self.user_data_cache[user_id]["status"] = int(text)
-            age, gender, city, status = (
-                self.user_data_cache[user_id]["age"],
-                self.user_data_cache[user_id]["gender"],
-                self.user_data_cache[user_id]["city"],
-                self.user_data_cache[user_id]["status"],
-            )
-            try:
-                users = self.vkinder.search_users(age, gender, city, status)
-            except ApiError:
-                self.send_message(user_id, messages.session_error)
-                return current_step
-            self.user_data_cache[user_id]['profiles'] = [user for user in users if
-                                                         not user.get('is_closed', True) and user['id'] not in
-                                                         self.user_data_cache[user_id]['in_db']][
-                                                        :self.top_users]
+            session.status = int(text)
+            # Новый поиск: сбрасываем буфер и незавершенную фоновую загрузку
+            session.cursor = None
+            session.profiles = []
+            session.photos = {}
+            session.prefetch = None
+            session.photo_prefetch = None
+            session.exhausted = False
 
             # Отправляем первую анкету, если она есть
-            next_profile = self.get_next_profile(user_id)
+            next_profile = self.get_next_profile(session)
             if next_profile:
-                link = f"https://vk.com/id{next_profile['id']}"
-                self.user_data_cache[user_id]['last'] = link
-                self.user_data.save_session_to_db(user_id, [next_profile["id"]])
-                self.user_data_cache[user_id]['in_db'].append(next_profile["id"])
-                top_photos = self.vkinder.get_top_photos(next_profile["id"])
-                self.send_photos_and_link(user_id, top_photos, link)
+                self.show_profile(session, next_profile)
 
             else:
                 self.send_message(user_id, messages.final_status)
@@ -376,7 +747,7 @@ class VKinderBot:
         :return:      Объект сессии
         """
         try:
-            session = vk_api.VkApi(token=token)
+            session = vk_api.VkApi(token=token, session=TimeoutSession())
         except vk_api.exceptions.ApiError as error:
             logging.error(error)
             return None